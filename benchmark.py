@@ -0,0 +1,296 @@
+"""
+Benchmark for File Tree Builder.
+
+Generates synthetic folder trees with controlled shapes, runs every scan mode on them
+through the same pipeline as the GUI and the command line, and reports end-to-end and
+per-phase timings as JSON, so two runs (e.g. before and after a change) can be compared.
+Runs offline, without the GUI (CustomTkinter is not needed).
+
+    python benchmark.py                          # all shapes, all modes, small scale
+    python benchmark.py --scale 4 -o after.json
+    python benchmark.py --shapes wide,tiny --modes classic --set scan_workers=8
+    python benchmark.py -o after.json --compare before.json --threshold 10
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+import importlib.util
+from pathlib import Path
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+MODES = {"classic": "Classic", "target": "Target", "no-content": "No Content"}
+GENERATOR_VERSION = 1 # Bump when a shape changes, so cached trees are rebuilt
+
+# Settings that would let a run reuse work from the previous one
+BENCHMARK_SETTINGS = {"scan_index": False, "content_cache": False, "timing_summary": False}
+
+
+def load_builder():
+    """ Imports file-tree-builder.py as a module (not as __main__, so no GUI is built). """
+    spec = importlib.util.spec_from_file_location("file_tree_builder", os.path.join(SCRIPT_DIR, "file-tree-builder.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# ======================================================================
+# Synthetic trees
+# ======================================================================
+CODE_LINE = b"    value = compute(item, index) + offset  # synthetic source line\n"
+LOG_LINE = b"2024-01-01T00:00:00.000Z INFO  worker-7 request handled in 12ms status=200 path=/api/items\n"
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def text_of_size(rng, size):
+    lines = CODE_LINE * (size // len(CODE_LINE) + 1)
+    return lines[:max(size - 1, 0)] + b"\n" if size else b""
+
+def gen_deep(root, rng, scale):
+    """ One long chain of folders, two small files per level. """
+    path = root
+    for level in range(int(300 * min(scale, 3))): # Depth is capped to stay below path-length limits
+        path = os.path.join(path, f"d{level % 10}")
+        os.mkdir(path)
+        write_file(os.path.join(path, "module.py"), text_of_size(rng, 400))
+        write_file(os.path.join(path, "notes.txt"), text_of_size(rng, 120))
+
+def gen_wide(root, rng, scale):
+    """ Many sibling folders with ~1 KB source files. """
+    for d in range(int(200 * scale)):
+        folder = os.path.join(root, "src", f"pkg{d:04d}")
+        os.makedirs(folder)
+        for f in range(50):
+            ext = (".py", ".js", ".md", ".json")[f % 4]
+            write_file(os.path.join(folder, f"file{f:03d}{ext}"), text_of_size(rng, rng.randint(200, 2000)))
+
+def gen_tiny(root, rng, scale):
+    """ Lots of tiny files. """
+    for d in range(int(40 * scale)):
+        folder = os.path.join(root, f"shard{d:03d}")
+        os.mkdir(folder)
+        for f in range(500):
+            write_file(os.path.join(folder, f"t{f:04d}.txt"), b"x" * rng.randint(1, 200) + b"\n")
+
+def gen_huge(root, rng, scale):
+    """ A few very large text files next to a handful of normal ones. """
+    os.makedirs(os.path.join(root, "logs"))
+    for i in range(3):
+        size = int(32 * 1024 * 1024 * scale)
+        with open(os.path.join(root, "logs", f"service{i}.log"), 'wb') as f:
+            block = LOG_LINE * (1024 * 1024 // len(LOG_LINE))
+            for _ in range(size // len(block)):
+                f.write(block)
+    for i in range(20):
+        write_file(os.path.join(root, f"main{i}.py"), text_of_size(rng, 4000))
+
+BINARY_MAGIC = (b"\x89PNG\r\n\x1a\n", b"PK\x03\x04", b"\x7fELF", b"")
+
+def gen_binary(root, rng, scale):
+    """ Half binary files (images, archives, executables, raw bytes), half text in UTF-8 and latin-1. """
+    for d in range(int(20 * scale)):
+        folder = os.path.join(root, f"assets{d:03d}")
+        os.mkdir(folder)
+        for f in range(100):
+            kind = f % 4
+            if kind < 2:
+                magic = BINARY_MAGIC[rng.randrange(len(BINARY_MAGIC))]
+                data = magic + rng.randbytes(rng.randint(2000, 60000))
+                write_file(os.path.join(folder, f"blob{f:03d}.dat"), data)
+            elif kind == 2:
+                write_file(os.path.join(folder, f"latin{f:03d}.txt"), "café crème brûlée\n".encode("latin-1") * 200)
+            else:
+                write_file(os.path.join(folder, f"utf8_{f:03d}.txt"), "naïve café – ok\n".encode("utf-8") * 200)
+
+IGNORE_DIRS = ("node_modules", "build", "dist", ".venv", "__pycache__", "coverage")
+
+def gen_ignore(root, rng, scale):
+    """ A project tree where a large ignore list (see ignore_patterns) hides much of the content. """
+    for d in range(int(100 * scale)):
+        base = os.path.join(root, "src", f"area{d:03d}")
+        for sub in ("", "gen") + IGNORE_DIRS[:2 + d % 4]:
+            folder = os.path.join(base, sub)
+            os.makedirs(folder, exist_ok=True)
+            for f in range(12):
+                ext = (".py", ".ts", ".min.js", ".map", ".log", ".txt")[f % 6]
+                write_file(os.path.join(folder, f"gen_{f:02d}{ext}" if sub == "gen" else f"item{f:02d}{ext}"),
+                           text_of_size(rng, rng.randint(100, 3000)))
+
+def ignore_patterns(count=1000):
+    """ Pipe-separated ignore list: literals, extension globs, name globs and path globs. """
+    patterns = list(IGNORE_DIRS) + ["*.min.js", "*.map", "*.log", "src/**/gen"]
+    for i in range(count - len(patterns)):
+        kind = i % 4
+        patterns.append((f"vendor{i}", f"*.x{i}", f"tmp{i}-*", f"src/area{i:03d}/cache{i}")[kind])
+    return "|".join(patterns)
+
+# name: (generator, Target Exts used for Target mode, Ignore Items used for Classic / No Content)
+SHAPES = {
+    "deep": (gen_deep, "py", ""),
+    "wide": (gen_wide, "py|md", ""),
+    "tiny": (gen_tiny, "txt", ""),
+    "huge": (gen_huge, "log", ""),
+    "binary": (gen_binary, "txt|dat", ""),
+    "ignore": (gen_ignore, "py|ts", ignore_patterns()),
+}
+
+def ensure_tree(workdir, shape, scale, seed):
+    """ Builds the tree of a shape once; later runs with the same parameters reuse it. """
+    root = os.path.join(workdir, shape)
+    spec = {"shape": shape, "scale": scale, "seed": seed, "version": GENERATOR_VERSION}
+    marker = os.path.join(workdir, f"{shape}.json")
+    try:
+        with open(marker, 'r', encoding='utf-8') as f:
+            if json.load(f) == spec and os.path.isdir(root):
+                return root
+    except (OSError, ValueError):
+        pass
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root)
+    started = time.perf_counter()
+    SHAPES[shape][0](root, random.Random(f"{seed}:{shape}"), scale)
+    with open(marker, 'w', encoding='utf-8') as f:
+        json.dump(spec, f)
+    print(f"generated {shape} in {time.perf_counter() - started:.1f} s", file=sys.stderr)
+    return root
+
+# ======================================================================
+# Runs
+# ======================================================================
+def run_case(builder, root, shape, mode_key, output_dir, repeat):
+    """ Runs one shape in one mode repeat times (after a warm-up run) and returns its result entry. """
+    _, target_exts, ignore_items = SHAPES[shape]
+    mode = MODES[mode_key]
+    root_path = Path(root)
+    output_path = Path(output_dir) / f"{shape}_{mode_key}.txt"
+    runs = []
+    for attempt in range(repeat + 1):
+        rules = builder.build_rules(mode, root_path, ignore_items=ignore_items, target_exts=target_exts)
+        started = time.perf_counter()
+        builder.run_generation(root_path, mode, rules, None, output_path)
+        seconds = time.perf_counter() - started
+        if attempt: # The first run only warms the OS caches
+            runs.append((seconds, builder.metrics.summary()))
+    seconds = [run[0] for run in runs]
+    median_summary = sorted(runs, key=lambda run: run[0])[len(runs) // 2][1]
+    phases = {name: round(statistics.median(run[1]["phases"].get(name, 0.0) for run in runs), 4)
+              for name in median_summary["phases"]}
+    return {
+        "shape": shape,
+        "mode": mode_key,
+        "runs": len(runs),
+        "seconds": {"min": round(min(seconds), 4), "median": round(statistics.median(seconds), 4),
+                    "max": round(max(seconds), 4)},
+        "phases": phases,
+        "counters": median_summary["counters"],
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def compare(results, baseline, threshold):
+    """ Prints the change of every case against a baseline; returns True if one slowed down past threshold %. """
+    before = {(entry["shape"], entry["mode"]): entry for entry in baseline["results"]}
+    regressed = False
+    print(f"{'case':<24}{'before':>10}{'after':>10}{'change':>9}", file=sys.stderr)
+    for entry in results["results"]:
+        old = before.get((entry["shape"], entry["mode"]))
+        if old is None:
+            continue
+        old_s, new_s = old["seconds"]["median"], entry["seconds"]["median"]
+        change = (new_s - old_s) / old_s * 100 if old_s else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressed = True
+        print(f"{entry['shape'] + '/' + entry['mode']:<24}{old_s:>10.3f}{new_s:>10.3f}{change:>+8.1f}%{flag}", file=sys.stderr)
+    return regressed
+
+def parse_setting(text):
+    key, sep, value = text.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got '{text}'")
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark File Tree Builder on synthetic trees.")
+    parser.add_argument("--shapes", default=",".join(SHAPES), help=f"comma-separated, from: {', '.join(SHAPES)}")
+    parser.add_argument("--modes", default=",".join(MODES), help=f"comma-separated, from: {', '.join(MODES)}")
+    parser.add_argument("--scale", type=float, default=1.0, help="tree size multiplier (default: 1)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case, after one warm-up run (default: 3)")
+    parser.add_argument("--seed", default="ftb", help="seed of the tree generator")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "ftb-benchmark"),
+                        help="where generated trees are kept between runs")
+    parser.add_argument("--set", dest="overrides", type=parse_setting, action="append", default=[], metavar="KEY=VALUE",
+                        help="override a settings.json value, e.g. --set scan_workers=8")
+    parser.add_argument("-o", "--output", metavar="FILE", help="write the JSON results here (default: stdout)")
+    parser.add_argument("--compare", metavar="FILE", help="baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="with --compare, exit with 1 when a case is this many %% slower (default: 10)")
+    args = parser.parse_args(argv)
+
+    shapes = [shape for shape in args.shapes.split(",") if shape]
+    modes = [mode for mode in args.modes.split(",") if mode]
+    unknown = [name for name in shapes if name not in SHAPES] + [name for name in modes if name not in MODES]
+    if unknown:
+        parser.error(f"unknown shape or mode: {', '.join(unknown)}")
+
+    builder = load_builder()
+    builder.headless = True
+    builder.settings.update(BENCHMARK_SETTINGS)
+    builder.settings.update(dict(args.overrides))
+
+    os.makedirs(args.workdir, exist_ok=True)
+    output_dir = tempfile.mkdtemp(prefix="outputs-", dir=args.workdir)
+    results = {
+        "generator_version": GENERATOR_VERSION,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scale": args.scale,
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "settings": dict(builder.settings),
+        "results": [],
+    }
+    try:
+        for shape in shapes:
+            root = ensure_tree(args.workdir, shape, args.scale, args.seed)
+            for mode_key in modes:
+                entry = run_case(builder, root, shape, mode_key, output_dir, args.repeat)
+                results["results"].append(entry)
+                print(f"{shape + '/' + mode_key:<24}{entry['seconds']['median']:>9.3f} s  {entry['phases']}", file=sys.stderr)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            if compare(results, json.load(f), args.threshold):
+                return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
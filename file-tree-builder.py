@@ -1,61 +1,34 @@
 import os
 import sys
-import tkinter as tk
-from tkinter import filedialog, messagebox
 from pathlib import Path
 import datetime
 import subprocess
 import threading
-import customtkinter as ctk
-import ctypes
-from ctypes import wintypes
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import deque
 import traceback # Import traceback for detailed error logging
 import json
+import re
+import io
+import codecs
+import mmap
+import contextlib
+import hashlib
+import time
+import sqlite3
+import heapq
+import cProfile
+import pstats
+import queue
+import gzip
+import lzma
+import bz2
+import bisect
+import errno
+import select
+import struct
+import signal
 
-# Drag & drop support (using windnd for Windows focus, similar to example)
-try:
-    import windnd
-    HAS_WINDND = True
-except ImportError:
-    HAS_WINDND = False
-    print("Optional dependency 'windnd' not found. Drag and drop will not work on Windows.")
-    print("Install using: pip install windnd")
-
-# ======================================================================
-# DPI Awareness & Window Centering (from example)
-# ======================================================================
-try:
-    # Try modern DPI awareness setting (Windows 8.1+)
-    ctypes.windll.shcore.SetProcessDpiAwareness(1) # PROCESS_PER_MONITOR_DPI_AWARE
-except AttributeError:
-    try:
-        # Fallback for older Windows versions
-        ctypes.windll.user32.SetProcessDPIAware()
-    except AttributeError:
-        pass # Not on Windows or ctypes issue
-
-def get_scaling_factor():
-    """Returns the system DPI scaling factor (e.g. 1.0 for 100%, 1.5 for 150%)."""
-    try:
-        # For Windows 10 and up
-        shcore = ctypes.windll.shcore
-        # Assuming PROCESS_PER_MONITOR_DPI_AWARE was set
-        dpi_x = ctypes.c_uint()
-        dpi_y = ctypes.c_uint()
-        # Get DPI for the primary monitor (or monitor associated with point 0,0)
-        monitor = ctypes.windll.user32.MonitorFromPoint(wintypes.POINT(0, 0), 2) # MONITOR_DEFAULTTOPRIMARY
-        shcore.GetDpiForMonitor(monitor, 0, ctypes.byref(dpi_x), ctypes.byref(dpi_y)) # MDT_EFFECTIVE_DPI
-        return dpi_x.value / 96.0
-    except Exception:
-        try:
-            # Fallback method (older Windows)
-            hdc = ctypes.windll.user32.GetDC(0)
-            LOGPIXELSX = 88 # Used to query DPI
-            dpi = ctypes.windll.gdi32.GetDeviceCaps(hdc, LOGPIXELSX)
-            ctypes.windll.user32.ReleaseDC(0, hdc)
-            return dpi / 96.0
-        except Exception:
-            return 1.0 # Default if everything fails
 
 # ======================================================================
 # RESOURCE HANDLING (from example, adapted)
@@ -92,6 +65,42 @@ lang_map = load_json_list("lang_map.json")                      # deja aveai
 ignore_items_list = load_json_list("ignore_items.json")
 ignore_exts_list  = load_json_list("ignore_exts.json")
 
+# Performance / behaviour knobs; helpers/settings.json overrides these defaults
+DEFAULT_SETTINGS = {
+    "scan_workers": 1,      # >1 lists folders in parallel (network drives)
+    "scan_index": True,     # reuse listings of unchanged folders from the previous run
+    "stream_hierarchy": True, # write the tree while scanning (Classic / No Content)
+    "use_gitignore": False, # initial state of the 'Respect .gitignore' checkbox
+    "read_workers": 4,      # threads reading file contents ahead of the writer
+    "read_prefetch_files": 64,
+    "read_buffer_mb": 64,   # max memory held by contents read ahead
+    "max_file_kb": 1024,    # bytes of each file written (0 = whole file)
+    "max_output_mb": 0,     # bytes of file contents written in total (0 = no limit)
+    "excerpt_large_files": False, # files over max_file_kb: write head and tail lines instead of the start
+    "excerpt_head_lines": 100,
+    "excerpt_tail_lines": 100,
+    "timing_summary": True, # write <output>.timing.json with phase timings and throughput
+    "content_cache": True,  # reuse the output blocks of unchanged files from earlier runs
+    "content_cache_mb": 512, # size cap of the content cache (least recently used blocks go first)
+    "profile_run": False,   # write <output>.prof and <output>.profile.txt (cProfile and slowest folders/files)
+    "profile_top": 25,      # entries in each list of the profile report
+    "output_format": "text", # "ndjson": one JSON record per folder and file (<name>.ndjson)
+    "output_compression": "none", # "gzip", "xz" or "bz2": write <name>.txt.gz / .txt.xz / .txt.bz2
+    "shard_mb": 0,          # >0 splits the output into <name>_part001.txt, ... of about this size
+    "shard_lines": 0,       # >0 also starts a new part after this many lines
+    "dedupe_contents": False, # write files identical to an earlier one as a reference to it
+    "block_index": False,   # write <output>.blocks.json with the byte offset of every file block
+}
+
+def load_settings(fname="settings.json"):
+    settings = dict(DEFAULT_SETTINGS)
+    loaded = load_json_list(fname)
+    if isinstance(loaded, dict):
+        settings.update(loaded)
+    return settings
+
+settings = load_settings()
+
 def get_outputs_folder_path():
     """
     Returns the absolute path for the outputs folder.
@@ -113,359 +122,939 @@ last_output_path = None
 stop_requested = False
 # Global reference to the app instance for safe_update
 app = None
+# True for command-line runs: safe_update calls status callbacks directly
+headless = False
 
 # ======================================================================
 # Core Logic Functions (No changes needed here for "No Content" mode)
 # ======================================================================
 
-def build_tree(current_path, ignored_items, root_path, status_callback):
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+class Hotspots:
+    """ The `size` slowest items recorded by any thread: (seconds, path, count), slowest first. """
+    def __init__(self, size):
+        self.size = size
+        self.heap = [] # Min-heap, so the fastest kept item is the one replaced
+        self.lock = threading.Lock()
+
+    def record(self, seconds, path, count):
+        with self.lock:
+            if len(self.heap) < self.size:
+                heapq.heappush(self.heap, (seconds, str(path), count))
+            elif seconds > self.heap[0][0]:
+                heapq.heapreplace(self.heap, (seconds, str(path), count))
+
+    def slowest(self):
+        with self.lock:
+            return sorted(self.heap, reverse=True)
+
+
+class RunMetrics:
     """
-    Recursively builds a dictionary representing the folder and file hierarchy.
-    Checks stop_requested flag periodically.
-    Adds ignored folders to the tree but doesn't recurse into them.
+    Counters and timings of one generation, shared by the scan, reader and writer
+    threads through the global `metrics` (replaced at the start of every run).
+    Timers add up time spent in each kind of work across all threads:
+      list_seconds     listing folders (directory I/O)
+      read_io_seconds  waiting on file reads (disk or network mount)
+      read_seconds     building content blocks: reading plus sniffing and decoding
+      wait_seconds     the writer waiting for read-ahead contents
+    Phases ('scan', 'hierarchy', 'dedupe', 'contents') are timed with `with metrics.phase(name):`.
+    slow_dirs / slow_files (Hotspots) are only kept while profiling (see enable_hotspots).
     """
-    global stop_requested
-    if stop_requested: return None
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.started_at = datetime.datetime.now()
+        self.values = {
+            "dirs": 0, "entries_listed": 0, "content_files": 0, "cache_hits": 0,
+            "bytes_read": 0, "bytes_written": 0, "errors": 0, "duplicates": 0,
+            "list_seconds": 0.0, "read_io_seconds": 0.0, "read_seconds": 0.0, "wait_seconds": 0.0,
+        }
+        self.phases = {}
+        self.phase_started = {}
+        self.slow_dirs = self.slow_files = None
+
+    def enable_hotspots(self, size):
+        self.slow_dirs = Hotspots(size)
+        self.slow_files = Hotspots(size)
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.values[name] += amount
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        self.phase_started[name] = started
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - started
+
+    def _phase_elapsed(self, name):
+        started = self.phase_started.get(name)
+        return max(time.perf_counter() - started, 1e-9) if started is not None else 1e-9
+
+    def scan_progress(self, relative_dir):
+        dirs = self.values["dirs"]
+        return f"Scanning: {relative_dir or '.'}... ({dirs:,} folders, {dirs / self._phase_elapsed('scan'):,.0f}/s)"
+
+    def content_progress(self, file_rel_path, done, total):
+        """ Progress message of the content phase, with throughput and the time left. """
+        elapsed = self._phase_elapsed("contents")
+        files_per_second = done / elapsed
+        mb_per_second = self.values["bytes_read"] / elapsed / (1024 * 1024)
+        eta = format_duration((total - done) / files_per_second) if files_per_second else "?"
+        return (f"Writing content: {file_rel_path} ({done}/{total}) – "
+                f"{files_per_second:,.0f} files/s, {mb_per_second:,.1f} MB/s, ETA {eta}")
+
+    def summary(self):
+        """ Machine-readable report of the run (see write_timing_summary). """
+        total = time.perf_counter() - self.started
+        values = dict(self.values)
+        def per_second(amount, phase):
+            seconds = self.phases.get(phase)
+            return round(amount / seconds, 1) if seconds else None
+        return {
+            "started": self.started_at.isoformat(timespec="seconds"),
+            "total_seconds": round(total, 3),
+            "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            "counters": {name: value for name, value in values.items() if not name.endswith("_seconds")},
+            "thread_seconds": {name: round(value, 3) for name, value in values.items() if name.endswith("_seconds")},
+            "rates": {
+                "dirs_per_second": per_second(values["dirs"], "scan"),
+                "content_files_per_second": per_second(values["content_files"], "contents"),
+                "read_mb_per_second": per_second(values["bytes_read"] / (1024 * 1024), "contents"),
+                "write_mb_per_second": round(values["bytes_written"] / (1024 * 1024) / total, 1) if total else None,
+            },
+        }
+
+metrics = RunMetrics()
+
+
+GLOB_CHARS = frozenset('*?[')
+
+def glob_to_regex(pattern):
+    """
+    Translates a glob into a regex source string.
+    '*' and '?' stay inside one path segment, '**/' matches zero or more folders
+    and a trailing '**' matches everything below.
+    """
+    i, n = 0, len(pattern)
+    out = []
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern.startswith('**/', i):
+                out.append('(?:.*/)?')
+                i += 3
+                continue
+            if pattern.startswith('**', i):
+                out.append('.*')
+                i += 2
+                continue
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                out.append('\\[') # Unclosed bracket is a literal
+            else:
+                stuff = pattern[i + 1:j].replace('\\', '\\\\')
+                if stuff.startswith('!'):
+                    stuff = '^' + stuff[1:]
+                elif stuff.startswith('^'):
+                    stuff = '\\' + stuff
+                out.append(f'[{stuff}]')
+                i = j
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
 
-    tree = {}
-    try:
-        # Avoid logging every single directory scan unless debugging is needed
-        # safe_update(status_callback, f"Scanning: {current_path.relative_to(root_path)}")
 
-        items_sorted = sorted(current_path.iterdir(), key=lambda x: (x.is_file(), x.name.lower()))
+class PatternMatcher:
+    """
+    A list of ignore/target patterns compiled once per run, queried with one call per entry.
+    - literals ('node_modules', 'docs/readme.md') -> set lookup on the name or relative path
+    - '.ext' literals also match a file's extension (this is how Ignore Exts entries arrive)
+    - '*.ext' style patterns ('*.egg-info', '*.min.js') -> suffix table, one lookup per '.' in the name
+    - any other glob ('build-*', '**/tmp', 'src/*.py') -> a single combined regex
+    Patterns containing '/' are matched against the relative path, the rest against the name.
+    A trailing '/' restricts a pattern to folders.
+    """
+    def __init__(self, patterns):
+        self.literals = set()
+        self.extensions = set()
+        self.suffixes = set()
+        name_globs = []
+        path_globs = []
+        dir_only = []
+
+        for pattern in patterns:
+            if pattern.endswith('/') and pattern.strip('/'):
+                dir_only.append(pattern.rstrip('/'))
+                continue
+            pattern = pattern.lstrip('/') # Leading '/' only anchors to the root, which path patterns are anyway
+            if not pattern:
+                continue
+            if not GLOB_CHARS.intersection(pattern):
+                self.literals.add(pattern)
+                if pattern.startswith('.') and '/' not in pattern:
+                    self.extensions.add(pattern)
+            elif pattern.startswith('*.') and '/' not in pattern and not GLOB_CHARS.intersection(pattern[1:]):
+                self.suffixes.add(pattern[1:])
+            elif '/' in pattern:
+                path_globs.append(glob_to_regex(pattern))
+            else:
+                name_globs.append(glob_to_regex(pattern))
+
+        self.name_regex = re.compile('(?:%s)\\Z' % '|'.join(name_globs)) if name_globs else None
+        self.path_regex = re.compile('(?:%s)\\Z' % '|'.join(path_globs)) if path_globs else None
+        self.dir_only = PatternMatcher(dir_only) if dir_only else None
+
+    def match(self, name, relative_path_str, is_dir=False):
+        """ True if the entry matches any pattern. """
+        if name in self.literals or relative_path_str in self.literals:
+            return True
+        if self.suffixes:
+            i = name.find('.')
+            while i != -1:
+                if name[i:] in self.suffixes:
+                    return True
+                i = name.find('.', i + 1)
+        if self.extensions and not is_dir and file_suffix(name) in self.extensions:
+            return True
+        if self.name_regex is not None and self.name_regex.match(name):
+            return True
+        if self.path_regex is not None and self.path_regex.match(relative_path_str):
+            return True
+        if is_dir and self.dir_only is not None:
+            return self.dir_only.match(name, relative_path_str, True)
+        return False
+
+
+class ClassicRules:
+    """
+    Filtering rules for Classic and No Content mode.
+    Ignored folders are listed in the tree but never entered; every file stays
+    in the tree, but ignored files (name, relative path, extension or glob) get no content.
+    """
+    # Whether an item is shown is known as soon as its folder is listed,
+    # so the hierarchy can be written while scanning (stream_tree)
+    streamable = True
 
-        for item in items_sorted:
-            if stop_requested: return None
+    def __init__(self, ignored_items):
+        self.ignored_items = ignored_items
+        self.matcher = PatternMatcher(ignored_items)
 
-            try:
-                relative_path_str = item.relative_to(root_path).as_posix()
-            except ValueError:
-                 # This can happen with symlinks pointing outside the root
-                 safe_update(status_callback, f"Warning: Skipping item outside root? '{item}'")
-                 continue
-
-            item_name = item.name
-
-            # --- Check if item itself should be ignored ---
-            # Check name first (common case)
-            is_ignored = item_name in ignored_items
-            # If not ignored by name, check full relative path
-            if not is_ignored and relative_path_str != '.': # Avoid checking '.' against ignored items
-                 is_ignored = relative_path_str in ignored_items
-            # If file, also check extension
-            if not is_ignored and item.is_file():
-                 is_ignored = item.suffix in ignored_items
-
-            if item.is_dir():
-                if is_ignored:
-                    # Add ignored directory name to tree, but mark it as empty/ignored
-                    tree[item_name] = {} # Represent as empty directory in output
-                    continue # IMPORTANT: Skip recursion into this ignored directory
-                else:
-                    # Recursively build subtree
-                    subtree = build_tree(item, ignored_items, root_path, status_callback)
-                    if subtree is not None: # Propagate stop signal if needed (subtree is None)
-                        # Only add non-empty subtrees unless it's explicitly empty ({})
-                        if subtree or isinstance(subtree, dict):
-                           tree[item_name] = subtree
-                    else:
-                        return None # Stop requested during subdirectory scan
-            elif item.is_file():
-                tree[item_name] = None
+    def root_state(self):
+        return None
 
-    except PermissionError:
-        safe_update(status_callback, f"Permission denied: '{current_path}'")
-    except FileNotFoundError:
-         safe_update(status_callback, f"Directory not found during scan: '{current_path}'")
-    except OSError as e:
-         # Catch other OS errors like 'Too many levels of symbolic links'
-         safe_update(status_callback, f"OS Error scanning '{current_path}': {e}")
-    except Exception as e:
-        safe_update(status_callback, f"Error scanning '{current_path}': {e}")
-        traceback.print_exc() # Log full traceback for unexpected errors
+    def enter_dir(self, current_path, relative_dir, entries, state):
+        """ Called once a folder has been listed; returns the state used for its items. """
+        return state
+
+    def check_dir(self, name, relative_path_str, state):
+        """ Returns (action, child_state); action is 'descend', 'show' or 'skip'. """
+        if self.matcher.match(name, relative_path_str, True):
+            return "show", None # Represent as empty directory in output
+        return "descend", None
+
+    def keep_dir(self, name, relative_path_str, child_state, subtree):
+        return True
+
+    def check_file(self, name, relative_path_str, suffix, state):
+        """ Returns (show_in_tree, include_content). """
+        return True, not self.matcher.match(name, relative_path_str)
 
-    # Return the generated tree dictionary. It might be empty if all items were ignored or inaccessible.
-    return tree
 
-def traverse_files(root_path, ignored_items, status_callback):
+def is_literal_path(pattern):
+    """ True for 'a/b/c' style items: contain a '/', no glob characters. """
+    return '/' in pattern.strip('/') and not GLOB_CHARS.intersection(pattern)
+
+
+def split_target_items(target_items, root_path):
     """
-    Walks through the directory and collects relative file paths,
-    respecting ignored items (folders, files, extensions).
-    Checks stop_requested flag periodically.
+    Splits Target Items into (folders, files).
+    Plain names without '.' are folders; so are literal paths that exist as folders
+    under root_path (e.g. 'docs/guide'). Everything else targets files.
     """
-    global stop_requested
-    file_paths = []
-    safe_update(status_callback, "Starting file traversal...")
-    processed_dirs = 0
-    try:
-        for dirpath, dirnames, filenames in os.walk(root_path, topdown=True, onerror=lambda e: safe_update(status_callback, f"Error accessing during walk: {e}")):
-            if stop_requested: return None # Stop traversal
+    target_folders = set()
+    for item in target_items:
+        if '/' not in item and '.' not in item:
+            target_folders.add(item)
+        elif is_literal_path(item) and (Path(root_path) / item.strip('/')).is_dir():
+            target_folders.add(item.strip('/'))
+    target_files = {item for item in target_items if item.strip('/') not in target_folders}
+    return target_folders, target_files
 
-            current_path_obj = Path(dirpath)
-            try:
-                current_rel_dir = current_path_obj.relative_to(root_path)
-            except ValueError:
-                 safe_update(status_callback, f"Warning: Skipping directory outside root? '{dirpath}'")
-                 dirnames[:] = [] # Don't traverse further down this path
-                 continue
-
-            processed_dirs += 1
-            if processed_dirs % 50 == 0: # Update status periodically for large trees
-                 safe_update(status_callback, f"Collecting files in: {current_rel_dir}...")
-
-            # Filter dirnames in-place based on ignored folders/paths
-            original_dirnames = list(dirnames) # Copy for iteration
-            dirnames[:] = [d for d in original_dirnames
-                           if d not in ignored_items and
-                           (current_rel_dir / d).as_posix() not in ignored_items]
-
-            for filename in filenames:
-                if stop_requested: return None # Check frequently
-
-                file_path = current_path_obj / filename
-                try:
-                    relative_file_path_str = file_path.relative_to(root_path).as_posix()
-                except ValueError:
-                     safe_update(status_callback, f"Warning: Skipping file outside root? '{file_path}'")
-                     continue
 
-                file_suffix = file_path.suffix
+class PathTrie:
+    """
+    Prefix tree of the literal path targets ('src/lib', 'docs/readme.md').
+    Nodes are plain dicts keyed by folder/file name; the scanner carries the node of
+    the current folder, so finding a child costs one dict lookup per level.
+    """
+    def __init__(self, paths):
+        self.root = {}
+        for path in paths:
+            node = self.root
+            for part in path.strip('/').split('/'):
+                node = node.setdefault(part, {})
 
-                # Check against ignored files (name or relative path) and extensions
-                if filename in ignored_items or \
-                   relative_file_path_str in ignored_items or \
-                   file_suffix in ignored_items:
-                    continue
+    @staticmethod
+    def child(node, name):
+        return node.get(name) if node is not None else None
 
-                file_paths.append(relative_file_path_str)
-    except Exception as e:
-        safe_update(status_callback, f"Error during file traversal: {e}")
-        traceback.print_exc()
-        return None # Indicate error
 
-    safe_update(status_callback, f"Finished file traversal. Found {len(file_paths)} files.")
-    return sorted(file_paths) if not stop_requested else None
+class TargetRules:
+    """
+    Filtering rules for Target mode.
+    The per-directory state is (in_target, trie_node): in_target is True once the walk
+    is inside a targeted folder, trie_node is the folder's node in the PathTrie of
+    literal path targets (None when it lies on no target path).
+    """
+    # Folders are only shown once their subtree turned out to contain a match
+    streamable = False
+
+    def __init__(self, target_folders, target_files, target_extensions):
+        self.target_folders = target_folders
+        self.target_files = target_files
+        self.target_extensions = target_extensions
+        self.folder_matcher = PatternMatcher(target_folders)
+        self.file_matcher = PatternMatcher(target_files)
+        self.trie = PathTrie(p for p in target_folders | target_files if is_literal_path(p))
+
+        # When every target is a literal path, nothing can match outside the trie:
+        # folders off every target path are pruned without being listed
+        folders_anywhere = any(not is_literal_path(p) for p in target_folders)
+        files_anywhere = bool(target_extensions) or any(not is_literal_path(p) for p in target_files)
+        self.anchored_only = bool(target_folders or target_files) and not folders_anywhere and not files_anywhere
+
+    def root_state(self):
+        return False, self.trie.root
+
+    def enter_dir(self, current_path, relative_dir, entries, state):
+        return state
+
+    def check_dir(self, name, relative_path_str, state):
+        parent_in_target, node = state
+        child_node = PathTrie.child(node, name)
+        # Is the directory itself explicitly targeted?
+        dir_is_targeted = self.folder_matcher.match(name, relative_path_str, True)
+        in_target = parent_in_target or dir_is_targeted
+
+        if self.anchored_only:
+            # Inside a targeted folder with no file targets every file matches;
+            # otherwise only folders on a target path can contain a match
+            should_descend = (in_target and not self.target_files) or child_node is not None
+        else:
+            # Should we descend into this directory?
+            # Yes if:
+            # 1. It's targeted or lies inside a targeted folder OR
+            # 2. No specific folders are targeted (meaning scan all folders) OR
+            # 3. Specific files/extensions are targeted (meaning this dir *might* contain them) OR
+            # 4. It lies on the path of a literal path target
+            should_descend = in_target or \
+                             not self.target_folders or \
+                             bool(self.target_files or self.target_extensions) or \
+                             child_node is not None
+        return ("descend" if should_descend else "skip"), (in_target, child_node)
+
+    def keep_dir(self, name, relative_path_str, child_state, subtree):
+        # Include the directory if it was explicitly targeted or contains targeted items
+        dir_is_targeted = self.folder_matcher.match(name, relative_path_str, True)
+        return dir_is_targeted or bool(subtree)
+
+    def check_file(self, name, relative_path_str, suffix, state):
+        # 1. Check if the file itself matches target files/extensions
+        file_criteria_met = False
+        if self.target_extensions and suffix in self.target_extensions:
+            file_criteria_met = True
+        if self.target_files and self.file_matcher.match(name, relative_path_str):
+            file_criteria_met = True
+        if not self.target_files and not self.target_extensions: # If no specific file targets, match all
+            file_criteria_met = True
+
+        # 2. Check if the file resides within a required directory path
+        path_criteria_met = state[0] or not self.target_folders
+
+        matched = file_criteria_met and path_criteria_met
+        return matched, matched
+
+
+class GitignoreLevel:
+    """ The compiled rules of one .gitignore (or .git/info/exclude) file. """
+    def __init__(self, base, lines):
+        self.base = base # Folder of the file, relative to the repository top ("" for the top)
+        self.rules = [] # (regex, negate, dir_only, anchored), in file order
+        for line in lines:
+            rule = self._compile_line(line)
+            if rule is not None:
+                self.rules.append(rule)
+
+    @staticmethod
+    def _compile_line(line):
+        line = line.rstrip('\r\n')
+        if not line or line.startswith('#'):
+            return None
+        # Trailing spaces are ignored unless escaped with a backslash
+        stripped = line.rstrip(' ')
+        if stripped.endswith('\\') and len(stripped) < len(line):
+            stripped += ' '
+        line = stripped
+        negate = False
+        if line.startswith('!'):
+            negate = True
+            line = line[1:]
+        elif line.startswith('\\!') or line.startswith('\\#'):
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            return None
+        # A slash at the start or in the middle anchors the pattern to this file's folder
+        anchored = '/' in line
+        regex = re.compile(glob_to_regex(line.lstrip('/')) + '\\Z')
+        return regex, negate, dir_only, anchored
+
+    def decide(self, repo_relative_path, name, is_dir):
+        """ True (ignored), False (re-included by '!') or None (no rule matches). Last match wins. """
+        relative = repo_relative_path[len(self.base) + 1:] if self.base else repo_relative_path
+        for regex, negate, dir_only, anchored in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative if anchored else name):
+                return not negate
+        return None
+
+
+def _read_gitignore_lines(path):
+    try:
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            return f.readlines()
+    except OSError:
+        return []
 
 
-def build_target_tree(current_path, target_folders, target_files, target_extensions, root_path, status_callback):
+class GitignoreRules:
     """
-    Recursively builds a hierarchy including only items that meet the target filters.
-    Checks stop_requested flag periodically.
+    Wraps ClassicRules or TargetRules and additionally drops everything git would ignore:
+    .gitignore files (read while walking), .git/info/exclude and the .gitignore files of
+    parent folders when the chosen folder is inside a repository. Negation ('!') is supported.
+    The per-directory state is (inner_state, levels); each folder's .gitignore is compiled
+    once and inherited by its subfolders, so ignored folders are pruned without being listed.
     """
-    global stop_requested
-    if stop_requested: return None
+    def __init__(self, inner, root_path):
+        self.inner = inner
+        root_path = Path(root_path)
+        self.prefix = "" # Chosen folder relative to the repository top
+        self.base_levels = ()
+
+        top = next((p for p in [root_path, *root_path.parents] if (p / ".git").exists()), None)
+        if top is None:
+            return
+        if top != root_path:
+            self.prefix = root_path.relative_to(top).as_posix()
+        levels = []
+        if (top / ".git").is_dir():
+            levels.append(GitignoreLevel("", _read_gitignore_lines(top / ".git" / "info" / "exclude")))
+        # .gitignore files above the chosen folder (the folder's own file is read during the walk)
+        folder = top
+        for part in Path(self.prefix).parts if self.prefix else ():
+            levels.append(GitignoreLevel(self._repo_path(folder, top), _read_gitignore_lines(folder / ".gitignore")))
+            folder = folder / part
+        self.base_levels = tuple(level for level in levels if level.rules)
+
+    @staticmethod
+    def _repo_path(folder, top):
+        relative = folder.relative_to(top).as_posix()
+        return "" if relative == "." else relative
+
+    def _repo_relative(self, relative_path_str):
+        if not self.prefix:
+            return relative_path_str
+        return f"{self.prefix}/{relative_path_str}" if relative_path_str else self.prefix
+
+    def _is_ignored(self, levels, name, relative_path_str, is_dir):
+        repo_relative_path = self._repo_relative(relative_path_str)
+        for level in reversed(levels): # Deeper files override their parents
+            decision = level.decide(repo_relative_path, name, is_dir)
+            if decision is not None:
+                return decision
+        return False
+
+    @property
+    def streamable(self):
+        return self.inner.streamable
+
+    def root_state(self):
+        return self.inner.root_state(), self.base_levels
+
+    def enter_dir(self, current_path, relative_dir, entries, state):
+        inner_state, levels = state
+        inner_state = self.inner.enter_dir(current_path, relative_dir, entries, inner_state)
+        for entry in entries:
+            if entry.name == ".gitignore" and entry.is_file():
+                level = GitignoreLevel(self._repo_relative(relative_dir), _read_gitignore_lines(entry.path))
+                if level.rules:
+                    levels = levels + (level,)
+                break
+        return inner_state, levels
+
+    def check_dir(self, name, relative_path_str, state):
+        inner_state, levels = state
+        if name == ".git" or self._is_ignored(levels, name, relative_path_str, True):
+            return "skip", None
+        action, child_inner_state = self.inner.check_dir(name, relative_path_str, inner_state)
+        return action, (child_inner_state, levels)
+
+    def keep_dir(self, name, relative_path_str, child_state, subtree):
+        return self.inner.keep_dir(name, relative_path_str, child_state[0], subtree)
+
+    def check_file(self, name, relative_path_str, suffix, state):
+        inner_state, levels = state
+        if self._is_ignored(levels, name, relative_path_str, False):
+            return False, False
+        return self.inner.check_file(name, relative_path_str, suffix, inner_state)
+
+
+def _entry_sort_key(entry):
+    return (entry.is_file(), entry.name.lower())
+
+def list_directory(current_path):
+    """
+    Returns the os.DirEntry items of a directory: folders first, then files,
+    each sorted case-insensitively.
+    DirEntry answers is_dir()/is_file() from the d_type reported by readdir and
+    caches the result, so only symlinks (or filesystems without d_type) cost a stat,
+    and at most one.
+    """
+    started = time.perf_counter()
+    with os.scandir(current_path) as it:
+        entries = list(it)
+    elapsed = time.perf_counter() - started
+    metrics.add("list_seconds", elapsed)
+    if metrics.slow_dirs is not None:
+        metrics.slow_dirs.record(elapsed, current_path, len(entries))
+    entries.sort(key=_entry_sort_key)
+    return entries
 
-    tree = {}
-    try:
-        # safe_update(status_callback, f"Scanning target: {current_path.relative_to(root_path)}")
-        items_sorted = sorted(current_path.iterdir(), key=lambda x: (x.is_file(), x.name.lower()))
+def file_suffix(name):
+    """ Same as Path(name).suffix, without building a Path object. """
+    i = name.rfind('.')
+    if 0 < i < len(name) - 1:
+        return name[i:]
+    return ''
 
-        for item in items_sorted:
-            if stop_requested: return None
 
-            try:
-                relative_path = item.relative_to(root_path)
-                relative_path_str = relative_path.as_posix()
-            except ValueError:
-                 safe_update(status_callback, f"Warning: Skipping target item outside root? '{item}'")
-                 continue
-
-            item_name = item.name
-
-            if item.is_dir():
-                # --- Directory Logic ---
-                # Is the directory itself explicitly targeted?
-                dir_is_targeted = item_name in target_folders or relative_path_str in target_folders
-
-                # Should we descend into this directory?
-                # Yes if:
-                # 1. It's explicitly targeted OR
-                # 2. No specific folders are targeted (meaning scan all folders) OR
-                # 3. Specific files/extensions are targeted (meaning this dir *might* contain them)
-                should_descend = dir_is_targeted or \
-                                 not target_folders or \
-                                 bool(target_files or target_extensions)
-
-                if should_descend:
-                    subtree = build_target_tree(item, target_folders, target_files, target_extensions, root_path, status_callback)
-                    if subtree is None: return None # Stop signal propagated
-
-                    # Include this directory in the output tree if:
-                    # 1. It was explicitly targeted OR
-                    # 2. It contains targeted items (subtree is not empty)
-                    if dir_is_targeted or subtree:
-                         tree[item_name] = subtree
-
-            elif item.is_file():
-                # --- File Logic ---
-                file_matches_criteria = False
-                # Match by extension? (Only if target extensions are specified)
-                if target_extensions and item.suffix in target_extensions:
-                    file_matches_criteria = True
-                # Match by specific file name or relative path? (Only if target files are specified)
-                # This overrides extension match if both are specified and file name matches.
-                if target_files and (item_name in target_files or relative_path_str in target_files):
-                    file_matches_criteria = True
-                # If no specific file/extension targets are given, include all files encountered
-                if not target_files and not target_extensions:
-                    file_matches_criteria = True
-
-                # Check if the file is within a required directory path (if target folders specified)
-                in_required_path = False
-                if not target_folders:
-                    in_required_path = True # No specific folders required
-                else:
-                    # Check if any parent part matches a target folder name or path
-                    current_parts = relative_path.parent.parts
-                    parent_rel_path_str = relative_path.parent.as_posix()
-                    if parent_rel_path_str == '.': parent_rel_path_str = "" # Handle root
+def _list_directory_unless_stopped(list_fn, current_path):
+    # Runs on a scan worker; skip the listing if the user pressed Stop meanwhile
+    if stop_requested:
+        return []
+    return list_fn(current_path)
 
-                    if any(part in target_folders for part in current_parts) or \
-                       (parent_rel_path_str and parent_rel_path_str in target_folders):
-                        in_required_path = True
-                    # Additionally, check if the *file's directory itself* is targeted (edge case for file in root of targeted dir)
-                    if not in_required_path and parent_rel_path_str in target_folders:
-                         in_required_path = True
 
+def get_scan_index_folder_path():
+    """ Scan indexes are kept in 'scan_index', next to the outputs folder. """
+    return os.path.join(os.path.dirname(get_outputs_folder_path()), "scan_index")
 
-                if file_matches_criteria and in_required_path:
-                    tree[item_name] = None
 
-    except PermissionError:
-        safe_update(status_callback, f"Permission denied: '{current_path}'")
-    except FileNotFoundError:
-         safe_update(status_callback, f"Directory not found during target scan: '{current_path}'")
-    except OSError as e:
-         safe_update(status_callback, f"OS Error scanning target '{current_path}': {e}")
-    except Exception as e:
-        safe_update(status_callback, f"Error scanning target '{current_path}': {e}")
-        traceback.print_exc()
+class _CachedEntry:
+    """ Stands in for os.DirEntry when a listing comes from the scan index. """
+    __slots__ = ("name", "parent", "kind")
+
+    def __init__(self, parent, name, kind):
+        self.name = name
+        self.parent = parent
+        self.kind = kind # 'd' folder, 'f' file, 'l' symlink (resolved when asked)
+
+    @property
+    def path(self):
+        # Built on demand: the scanner only needs the path of the folders it enters
+        return os.path.join(self.parent, self.name)
+
+    def is_dir(self):
+        if self.kind == 'l':
+            return os.path.isdir(self.path) # A symlink can be re-pointed without touching its folder
+        return self.kind == 'd'
 
-    return tree
+    def is_file(self):
+        if self.kind == 'l':
+            return os.path.isfile(self.path)
+        return self.kind == 'f'
 
+    def is_symlink(self):
+        return self.kind == 'l'
 
-def traverse_target_files(root_path, target_folders, target_files, target_extensions, status_callback):
+
+class ScanIndex:
     """
-    Walks through the directory and collects relative file paths that match the target filters.
-    Checks stop_requested flag periodically.
+    On-disk cache of the folder listings of one root path, stored as JSON in
+    get_scan_index_folder_path(). Each folder is recorded with its mtime and inode:
+    adding, removing or renaming an entry changes the folder's mtime, so a folder
+    whose stat still matches is served from the index instead of being listed again.
+    Listings are stored unfiltered, so changing the filters between runs is safe.
+    """
+    VERSION = 1
+    # A folder changed within this window of being listed may change again without
+    # its mtime moving (coarse timestamps), so such listings are never reused
+    RACY_NS = 2 * 10**9
+
+    def __init__(self, root_path, index_path=None):
+        self.prefix = os.fspath(root_path)
+        root_key = os.path.normcase(os.path.abspath(self.prefix))
+        if index_path is None:
+            digest = hashlib.sha1(root_key.encode('utf-8', 'surrogatepass')).hexdigest()[:16]
+            index_path = os.path.join(get_scan_index_folder_path(), f"{digest}.json")
+        self.index_path = index_path
+        self.root_key = root_key
+        self.old = {}
+        self.new = {}
+
+    def load(self):
+        """ Reads the previous run's index; a missing or unreadable index is simply empty. """
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION and data.get("root") == self.root_key:
+                self.old = data["dirs"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            self.old = {}
+        return self
+
+    def _key(self, current_path):
+        return current_path[len(self.prefix):].lstrip("/\\")
+
+    def list_directory(self, current_path):
+        """ Same result as list_directory(), reusing the indexed listing when the folder is unchanged. """
+        key = self._key(current_path)
+        st = os.stat(current_path)
+        record = self.old.get(key)
+        if record is not None and record[0] == st.st_mtime_ns and record[1] == st.st_ino:
+            self.new[key] = record
+            return [_CachedEntry(current_path, name, kind) for name, kind in zip(record[2], record[3])]
+
+        listed_ns = time.time_ns()
+        entries = list_directory(current_path)
+        names = []
+        kinds = []
+        for entry in entries:
+            if entry.is_symlink():
+                kind = 'l'
+            elif entry.is_dir():
+                kind = 'd'
+            elif entry.is_file():
+                kind = 'f'
+            else:
+                continue # Sockets, pipes, ... are never shown
+            names.append(entry.name)
+            kinds.append(kind)
+        mtime = st.st_mtime_ns if st.st_mtime_ns + self.RACY_NS < listed_ns else None
+        self.new[key] = [mtime, st.st_ino, names, "".join(kinds)]
+        return entries
+
+    @property
+    def reused(self):
+        return sum(1 for key, record in self.new.items() if self.old.get(key) is record)
+
+    @property
+    def changed(self):
+        return self.reused != len(self.new) or len(self.new) != len(self.old)
+
+    def save(self):
+        """
+        Writes the folders seen in this run (folders no longer reached drop out).
+        The file is replaced atomically, so an interrupted save keeps the old index.
+        """
+        if not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        data = json.dumps({"version": self.VERSION, "root": self.root_key, "dirs": self.new},
+                          ensure_ascii=False, separators=(',', ':'))
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp" # Runs of the same root may overlap (batch mode)
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp_path, self.index_path)
+
+
+class DirectoryLister:
+    """
+    Hands out list_directory() results to the scanner.
+    With more than one worker, the folders the scanner is about to enter are listed
+    ahead of time on a bounded thread pool. The scanner still consumes the listings
+    in depth-first order, so the tree and file order match a sequential scan exactly.
+    """
+    def __init__(self, workers=1, max_pending=None, index=None):
+        self.list_fn = index.list_directory if index is not None else list_directory
+        self.executor = None
+        if workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scan")
+        # Cap on listings fetched but not consumed yet (keeps memory bounded on wide trees)
+        self.max_pending = max_pending or workers * 64
+        self.pending = {}
+
+    def prefetch(self, path):
+        if self.executor is None or path in self.pending or len(self.pending) >= self.max_pending:
+            return
+        self.pending[path] = self.executor.submit(_list_directory_unless_stopped, self.list_fn, path)
+
+    def get(self, path):
+        future = self.pending.pop(path, None)
+        if future is None:
+            return self.list_fn(path)
+        return future.result() # Re-raises PermissionError etc. from the worker
+
+    def close(self):
+        if self.executor is None:
+            return
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False)
+
+
+class _ScanState:
+    """ Per-run data shared by all levels of the recursive scan. """
+    def __init__(self, rules, lister, file_paths, status_callback):
+        self.rules = rules
+        self.lister = lister
+        self.file_paths = file_paths
+        self.status_callback = status_callback
+        self.dirs = 0
+
+
+def scan_tree(root_path, rules, status_callback, collect_files=True, workers=1, index=None):
+    """
+    Walks the directory once and returns (tree, file_paths):
+    the nested dict used by print_tree and the relative paths of the files whose
+    content should be written, already in hierarchy order.
+    file_paths is None when collect_files is False (No Content mode).
+    workers > 1 lists folders in parallel (useful on network drives).
+    index (a ScanIndex) reuses the listings of folders unchanged since the last run.
+    Returns (None, None) if the operation was stopped.
     """
     global stop_requested
-    file_paths = []
-    safe_update(status_callback, "Starting target file traversal...")
-    processed_dirs = 0
+    file_paths = [] if collect_files else None
+    scan = _ScanState(rules, DirectoryLister(workers, index=index), file_paths, status_callback)
     try:
-        for dirpath, dirnames, filenames in os.walk(root_path, topdown=True, onerror=lambda e: safe_update(status_callback, f"Error accessing during target walk: {e}")):
-            if stop_requested: return None
+        tree = _scan_dir(scan, os.fspath(root_path), "", rules.root_state(), collect_files)
+    finally:
+        scan.lister.close()
+    if tree is None or stop_requested:
+        return None, None
+
+    if collect_files:
+        safe_update(status_callback, f"Finished scan. {scan.dirs} folders, {len(file_paths)} files selected for content.")
+    else:
+        safe_update(status_callback, f"Finished scan. {scan.dirs} folders.")
+    return tree, file_paths
 
-            current_path_obj = Path(dirpath)
-            try:
-                current_rel_dir = current_path_obj.relative_to(root_path)
-                current_rel_dir_str = current_rel_dir.as_posix()
-                if current_rel_dir_str == '.': current_rel_dir_str = "" # Handle root case for checks
-            except ValueError:
-                 safe_update(status_callback, f"Warning: Skipping target directory outside root? '{dirpath}'")
-                 dirnames[:] = []
-                 continue
-
-            processed_dirs += 1
-            if processed_dirs % 50 == 0:
-                 safe_update(status_callback, f"Collecting target files in: {current_rel_dir}...")
-
-            # --- Directory Filtering (Pruning os.walk) ---
-            original_dirnames = list(dirnames)
-            dirnames[:] = [] # Clear and rebuild based on whether to descend
-            for d in original_dirnames:
-                if stop_requested: return None
-                dir_rel_path_str = (current_rel_dir / d).as_posix()
-
-                # Should we descend into this directory 'd'?
-                scan_all_folders = not target_folders
-                dir_is_targeted = d in target_folders or dir_rel_path_str in target_folders
-                is_under_target_folder = False
-                if target_folders:
-                     for target_f in target_folders:
-                         if dir_rel_path_str == target_f or dir_rel_path_str.startswith(target_f + '/'):
-                              is_under_target_folder = True
-                              break
-                potential_container = bool(target_files or target_extensions)
-
-                if scan_all_folders or dir_is_targeted or is_under_target_folder or potential_container:
-                     dirnames.append(d)
-
-
-            # --- File Filtering (within the current dirpath) ---
-            for filename in filenames:
-                if stop_requested: return None
-
-                file_path = current_path_obj / filename
-                try:
-                    relative_file_path = file_path.relative_to(root_path)
-                    relative_file_path_str = relative_file_path.as_posix()
-                except ValueError:
-                     safe_update(status_callback, f"Warning: Skipping target file outside root? '{file_path}'")
-                     continue
-
-                file_suffix = file_path.suffix
-                file_name = file_path.name
-
-                # 1. Check if the file itself matches target files/extensions
-                file_criteria_met = False
-                if target_extensions and file_suffix in target_extensions:
-                    file_criteria_met = True
-                if target_files and (file_name in target_files or relative_file_path_str in target_files):
-                    file_criteria_met = True
-                if not target_files and not target_extensions: # If no specific file targets, match all
-                     file_criteria_met = True
-
-                # 2. Check if the file resides within a required directory path
-                path_criteria_met = False
-                if not target_folders: # If no specific folders targeted, path is always OK
-                    path_criteria_met = True
-                else:
-                    current_parts = relative_file_path.parent.parts
-                    parent_rel_path_str = relative_file_path.parent.as_posix()
-                    if parent_rel_path_str == '.': parent_rel_path_str = "" # Handle root case
 
-                    if (relative_file_path.parent.name in target_folders) or \
-                       (parent_rel_path_str and parent_rel_path_str in target_folders):
-                         path_criteria_met = True
-                    elif any(part in target_folders for part in current_parts):
-                         path_criteria_met = True
+def _report_scan_error(status_callback, current_path, error):
+    metrics.add("errors")
+    if isinstance(error, PermissionError):
+        safe_update(status_callback, f"Permission denied: '{current_path}'")
+    elif isinstance(error, FileNotFoundError):
+         safe_update(status_callback, f"Directory not found during scan: '{current_path}'")
+    elif isinstance(error, OSError):
+         # Catch other OS errors like 'Too many levels of symbolic links'
+         safe_update(status_callback, f"OS Error scanning '{current_path}': {error}")
+    else:
+        safe_update(status_callback, f"Error scanning '{current_path}': {error}")
+        traceback.print_exc() # Log full traceback for unexpected errors
 
 
-                if file_criteria_met and path_criteria_met:
-                    file_paths.append(relative_file_path_str)
+def _plan_dir(scan, current_path, relative_dir, state):
+    """
+    Lists current_path and decides what to do with every item, so the folders we are
+    going to enter can be listed ahead of time by the scan workers.
+    Returns [(item, name, relative_path_str, action, extra)] for the items shown in the tree:
+    action 'descend' or 'show' (folder, extra = child state) or 'file' (extra = include content).
+    """
+    scan.dirs += 1
+    metrics.add("dirs")
+    if scan.dirs % 50 == 0: # Update status periodically for large trees
+        report_progress(scan.status_callback, metrics.scan_progress(relative_dir))
+
+    rules = scan.rules
+    entries = scan.lister.get(current_path)
+    metrics.add("entries_listed", len(entries))
+    state = rules.enter_dir(current_path, relative_dir, entries, state)
+    plan = []
+    for item in entries:
+        item_name = item.name
+        # Relative paths are built from names, so symlinks pointing outside the root are fine
+        relative_path_str = f"{relative_dir}/{item_name}" if relative_dir else item_name
+
+        if item.is_dir():
+            action, child_state = rules.check_dir(item_name, relative_path_str, state)
+            if action == "descend":
+                scan.lister.prefetch(item.path)
+            if action != "skip":
+                plan.append((item, item_name, relative_path_str, action, child_state))
+        elif item.is_file():
+            show, include_content = rules.check_file(item_name, relative_path_str, file_suffix(item_name), state)
+            if show:
+                plan.append((item, item_name, relative_path_str, "file", include_content))
+    return plan
+
+
+def _scan_dir(scan, current_path, relative_dir, state, collect):
+    """
+    Builds the hierarchy dict of current_path (a path string; relative_dir is its POSIX
+    path relative to the root, "" for the root) and appends the files selected for
+    content to scan.file_paths. The walk uses an explicit stack, so very deep trees do
+    not hit the recursion limit; rules.keep_dir is applied once a folder is finished.
+    Content is not collected below symlinked folders (they are still shown in the tree).
+    Returns None if stop_requested was set.
+    """
+    rules = scan.rules
+    root_tree = {}
+    stack = [] # [plan, next index, tree, collect, (name, rel, state, parent tree)] per open folder
 
-    except Exception as e:
-        safe_update(status_callback, f"Error during target file traversal: {e}")
-        traceback.print_exc()
-        return None # Indicate error
+    def open_dir(path, rel, dir_state, tree, dir_collect, parent):
+        try:
+            plan = _plan_dir(scan, path, rel, dir_state)
+        except Exception as e:
+            _report_scan_error(scan.status_callback, path, e)
+            plan = [] # Keep the (empty) folder, as an unreadable folder always was
+        stack.append([plan, 0, tree, dir_collect, parent])
+
+    open_dir(current_path, relative_dir, state, root_tree, collect, None)
+    while stack:
+        if stop_requested: return None
+
+        frame = stack[-1]
+        plan, index, tree, dir_collect, parent = frame
+        if index == len(plan):
+            stack.pop()
+            if parent is not None:
+                item_name, relative_path_str, child_state, parent_tree = parent
+                if rules.keep_dir(item_name, relative_path_str, child_state, tree):
+                    parent_tree[item_name] = tree
+            continue
+        frame[1] = index + 1
+
+        item, item_name, relative_path_str, action, extra = plan[index]
+        if action == "show":
+            tree[item_name] = {} # Listed, but not entered
+        elif action == "descend":
+            child_collect = dir_collect and not item.is_symlink()
+            open_dir(item.path, relative_path_str, extra, {}, child_collect,
+                     (item_name, relative_path_str, extra, tree))
+        else: # file
+            tree[item_name] = None
+            if extra and dir_collect and scan.file_paths is not None:
+                scan.file_paths.append(relative_path_str)
+
+    # It might be empty if all items were ignored or inaccessible.
+    return root_tree
+
+
+def stream_tree(root_path, rules, output_file, status_callback, collect_files=True, workers=1, index=None,
+                entry_line=None):
+    """
+    Scans root_path and writes the hierarchy lines (below the root name) straight to
+    output_file while walking, without building the nested dict or the list of lines.
+    The walk is iterative: memory is one listing per folder level, whatever the
+    tree size or depth. Requires rules.streamable (see ClassicRules).
+    workers and index work as in scan_tree. With entry_line(path, relative_path_str, is_dir)
+    its result is written instead of the tree line of each folder and of each file
+    not collected for content (see entry_record).
+    Returns (line_count, file_paths), or (None, None) if the operation was stopped.
+    """
+    file_paths = [] if collect_files else None
+    scan = _ScanState(rules, DirectoryLister(workers, index=index), file_paths, status_callback)
+    line_count = 0
+    stack = [] # [plan, next index, prefix, collect] per open folder
+
+    def open_dir(current_path, relative_dir, state, prefix, collect):
+        try:
+            plan = _plan_dir(scan, current_path, relative_dir, state)
+        except Exception as e:
+            _report_scan_error(status_callback, current_path, e)
+            return
+        stack.append([plan, 0, prefix, collect])
 
-    safe_update(status_callback, f"Finished target file traversal. Found {len(file_paths)} files.")
-    return sorted(file_paths) if not stop_requested else None
+    try:
+        open_dir(os.fspath(root_path), "", rules.root_state(), "", collect_files)
+        while stack:
+            if stop_requested: return None, None
+
+            frame = stack[-1]
+            plan, index, prefix, collect = frame
+            if index == len(plan):
+                stack.pop()
+                continue
+            frame[1] = index + 1
+
+            item, item_name, relative_path_str, action, extra = plan[index]
+            is_last = index == len(plan) - 1
+            collected = action == "file" and extra and collect and file_paths is not None
+            if entry_line is None:
+                output_file.write(prefix + ("└── " if is_last else "├── ") + item_name + "\n")
+            elif not collected:
+                output_file.write(entry_line(item.path, relative_path_str, action != "file"))
+            line_count += 1
+
+            if action == "descend":
+                child_collect = collect and not item.is_symlink()
+                open_dir(item.path, relative_path_str, extra, prefix + ("    " if is_last else "│   "), child_collect)
+            elif collected:
+                file_paths.append(relative_path_str)
+    finally:
+        scan.lister.close()
+
+    if collect_files:
+        safe_update(status_callback, f"Finished scan. {scan.dirs} folders, {len(file_paths)} files selected for content.")
+    else:
+        safe_update(status_callback, f"Finished scan. {scan.dirs} folders.")
+    return line_count, file_paths
 
 
 def print_tree(tree, prefix="", tree_lines=None):
     """
     Generates a list of strings representing the folder tree.
     Handles potentially None or non-dict subtrees gracefully.
+    Iterative, so very deep trees cannot hit the recursion limit.
     """
     if tree_lines is None:
         tree_lines = []
     if not isinstance(tree, dict): # Handle cases where tree might be None
         return tree_lines
 
-    items = list(tree.items())
-    for index, (name, subtree) in enumerate(items):
-        is_last = index == len(items) - 1
+    stack = [(iter(tree.items()), len(tree), prefix, [0])]
+    while stack:
+        items, count, prefix, position = stack[-1]
+        entry = next(items, None)
+        if entry is None:
+            stack.pop()
+            continue
+        name, subtree = entry
+        position[0] += 1
+        is_last = position[0] == count
         connector = "└── " if is_last else "├── "
-        line = prefix + connector + name
-        tree_lines.append(line)
+        tree_lines.append(prefix + connector + name)
 
-        # Only recurse if the subtree is a dictionary (representing a directory)
+        # Only descend if the subtree is a dictionary (representing a directory)
         if isinstance(subtree, dict):
             extension = "    " if is_last else "│   "
-            print_tree(subtree, prefix + extension, tree_lines)
+            stack.append((iter(subtree.items()), len(subtree), prefix + extension, [0]))
 
     return tree_lines
 
@@ -480,64 +1069,994 @@ def write_hierarchy(output_file, tree_lines, status_callback):
             output_file.write(line + "\n")
     output_file.write("\n")
 
-def write_file_contents(output_file, root_path, file_paths, status_callback):
+MAX_CONTENT_BYTES = 1024 * 1024 # Default per-file cap: write at most 1 MiB of each file
+CHUNK_BYTES = 256 * 1024 # Contents are read and decoded in chunks of this size
+MMAP_MIN_BYTES = 16 * 1024 * 1024 # Files this large are read through a memory map...
+MMAP_WINDOW_BYTES = 16 * CHUNK_BYTES # ...mapped a window at a time (a multiple of mmap.ALLOCATIONGRANULARITY)
+STREAM_MIN_BYTES = 4 * 1024 * 1024 # Larger contents are copied to the output chunk by chunk
+TRUNCATED_NOTE = "\n... (file content truncated due to size)"
+LATIN1_NOTE = "\n... (Note: Read using latin-1 encoding)"
+REPLACED_NOTE = "\n... (Note: {count:,} invalid UTF-8 byte sequences replaced with U+FFFD)"
+
+def read_file_content(full_path, max_bytes=MAX_CONTENT_BYTES, excerpt=None):
+    """
+    Returns the text to place inside a file's code fence: at most max_bytes
+    of the file (0 = all of it), decoded. With excerpt = (head_lines, tail_lines)
+    a larger file is shown as its first and last lines instead (see read_excerpt).
+    Read errors are returned as text so one bad file never aborts the whole output.
+    """
+    return _read_file_content(full_path, max_bytes, excerpt)[0]
+
+
+# --- Content sniffing: decides binary vs. text and the encoding from the first bytes ---
+SNIFF_BYTES = 8192
+# Bytes that appear in text files (as in file(1)): printable ASCII, common control
+# characters and everything >= 0x80 (UTF-8 sequences, latin-1 letters)
+_TEXT_BYTES = bytes({7, 8, 9, 10, 11, 12, 13, 27} | set(range(0x20, 0x100)) - {0x7f})
+BINARY_NONTEXT_RATIO = 0.30
+BOM_ENCODINGS = ( # Longest first: the UTF-32 LE BOM starts with the UTF-16 LE one
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+BINARY_MAGIC = (
+    b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'GIF87a', b'GIF89a', b'%PDF-',
+    b'PK\x03\x04', b'PK\x05\x06', b'\x1f\x8b', b'\xfd7zXZ\x00', b'7z\xbc\xaf\x27\x1c',
+    b'Rar!\x1a\x07', b'\x7fELF', b'\xca\xfe\xba\xbe', b'\xcf\xfa\xed\xfe', b'\xce\xfa\xed\xfe',
+    b'SQLite format 3\x00', b'\x00asm', b'OggS', b'fLaC', b'RIFF', b'wOFF', b'wOF2',
+)
+
+def sniff_encoding(head):
+    """
+    Looks at the first bytes of a file (up to SNIFF_BYTES) and returns the encoding
+    to read it with, or None for a binary file: a known magic number, a NUL byte
+    or too many control characters. Text is 'utf-8' when the window decodes as
+    UTF-8, 'latin-1' otherwise; a BOM selects its encoding.
+    """
+    for bom, encoding in BOM_ENCODINGS:
+        if head.startswith(bom):
+            return encoding
+    if head.startswith(BINARY_MAGIC) or b'\x00' in head:
+        return None
+    if len(head.translate(None, _TEXT_BYTES)) > len(head) * BINARY_NONTEXT_RATIO:
+        return None
+    try:
+        # A multi-byte character may be cut at the end of the window
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=len(head) < SNIFF_BYTES)
+    except UnicodeDecodeError:
+        return 'latin-1'
+    return 'utf-8'
+
+
+def content_limit(size, max_bytes):
+    """ Bytes written of a file of the given size (max_bytes 0 = no cap). """
+    return min(size, max_bytes) if max_bytes else size
+
+
+def binary_placeholder(size):
+    return f"(binary file, {size:,} bytes – content skipped)"
+
+def duplicate_placeholder(original_rel_path):
+    return f"(identical to {original_rel_path} – content skipped)"
+
+
+def read_counted(raw, size):
+    """ raw.read(size), adding the bytes and the time taken to the run metrics. """
+    started = time.perf_counter()
+    data = raw.read(size)
+    with metrics.lock:
+        metrics.values["read_io_seconds"] += time.perf_counter() - started
+        metrics.values["bytes_read"] += len(data)
+    return data
+
+
+def iter_file_bytes(raw, size, limit):
+    """
+    Yields the first limit bytes of the binary file object raw in chunks of
+    CHUNK_BYTES. Files of MMAP_MIN_BYTES or more are read through a memory map,
+    handing out views of it instead of copies; only one window of the file is
+    mapped at a time, so resident memory stays bounded too.
+    """
+    if size >= MMAP_MIN_BYTES:
+        end = min(limit, size)
+        for offset in range(0, end, MMAP_WINDOW_BYTES):
+            length = min(MMAP_WINDOW_BYTES, end - offset)
+            with mmap.mmap(raw.fileno(), length, access=mmap.ACCESS_READ, offset=offset) as mm:
+                metrics.add("bytes_read", length) # Page faults happen while decoding, so no I/O time here
+                for start in range(0, length, CHUNK_BYTES):
+                    with memoryview(mm)[start:start + CHUNK_BYTES] as chunk:
+                        yield chunk
+        return
+    raw.seek(0)
+    remaining = limit
+    while remaining > 0:
+        chunk = read_counted(raw, min(CHUNK_BYTES, remaining))
+        if not chunk:
+            return
+        remaining -= len(chunk)
+        yield chunk
+
+
+def iter_file_text(chunks, encoding, final=True, errors='strict'):
+    """
+    Decodes byte chunks incrementally, translating newlines as text-mode reads do.
+    With final=False (content cut by a cap) a multi-byte character split at the
+    end is dropped instead of raising.
+    """
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(errors), translate=True)
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    if final:
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+
+
+_replaced = threading.local() # Count kept by the "count-replace" error handler, per decoding thread
+
+def _count_replace(error):
+    # errors='replace' (one U+FFFD per invalid sequence) that also counts what it replaced
+    _replaced.count = getattr(_replaced, "count", 0) + 1
+    return "\ufffd", error.end
+
+codecs.register_error("count-replace", _count_replace)
+
+
+# Encodings whose newline is the single byte b'\n', which excerpts search for
+EXCERPT_ENCODINGS = ('utf-8', 'utf-8-sig', 'latin-1')
+EXCERPT_FIRST_READ = 16 * 1024 # Excerpt reads start at this size and double up to CHUNK_BYTES
+
+def _after_nth_newline(data, n):
+    # Index just after the n-th b'\n' of data, or None if there are fewer
+    index = 0
+    for _ in range(n):
+        index = data.find(b'\n', index)
+        if index < 0:
+            return None
+        index += 1
+    return index
+
+def _start_of_last_lines(data, n):
+    # Index where the last n lines of data start (a final newline ends the last line), or None
+    index = len(data) - 1 if data.endswith(b'\n') else len(data)
+    for _ in range(n):
+        index = data.rfind(b'\n', 0, index)
+        if index < 0:
+            return None
+    return index + 1
+
+def read_excerpt(raw, size, encoding, head_lines, tail_lines, max_bytes):
+    """
+    Returns (text, encoding): the first head_lines and the last tail_lines of the
+    open binary file raw, joined by a line giving the number of bytes skipped.
+    Each side is at most max_bytes // 2 bytes, and little more than those bytes is
+    read: reads start small and double, and the tail is found by reading backwards
+    from the end of the file.
+    encoding must be one of EXCERPT_ENCODINGS; it turns to 'latin-1' if the
+    excerpt is not valid UTF-8.
+    """
+    side = max_bytes // 2
+    raw.seek(0)
+    head = b""
+    end = 0 if head_lines <= 0 else None
+    step = EXCERPT_FIRST_READ
+    while end is None and len(head) < side:
+        chunk = read_counted(raw, min(step, side - len(head)))
+        if not chunk:
+            break
+        head += chunk
+        end = _after_nth_newline(head, head_lines)
+        step = min(step * 2, CHUNK_BYTES)
+    head = head[:end]
+
+    tail = b""
+    start = 0 if tail_lines <= 0 else None
+    position = size
+    step = EXCERPT_FIRST_READ
+    while start is None and position > len(head) and len(tail) < side:
+        length = min(step, position - len(head), side - len(tail))
+        position -= length
+        raw.seek(position)
+        tail = read_counted(raw, length) + tail
+        start = _start_of_last_lines(tail, tail_lines)
+        step = min(step * 2, CHUNK_BYTES)
+    if start is None and position > len(head):
+        # Cut inside a line by the byte limit: begin at a character boundary
+        start = 0
+        while encoding != 'latin-1' and start < len(tail) and 0x80 <= tail[start] < 0xC0:
+            start += 1
+    tail = tail[start or 0:]
+    skipped = size - len(head) - len(tail)
+
+    def decode(data, data_encoding):
+        return "".join(iter_file_text([data], data_encoding, final=False))
+    try:
+        head_text = decode(head, encoding)
+        tail_text = decode(tail, 'utf-8' if encoding == 'utf-8-sig' else encoding)
+    except UnicodeDecodeError:
+        encoding = 'latin-1'
+        head_text = decode(head, encoding)
+        tail_text = decode(tail, encoding)
+    if head_text and not head_text.endswith("\n"):
+        head_text += "\n"
+    return f"{head_text}... ({skipped:,} bytes skipped) ...\n{tail_text}", encoding
+
+
+class FileText:
+    """ A file as read for the output: its text (None for a binary file or a read error) and how it was read. """
+    __slots__ = ("text", "size", "encoding", "truncated", "excerpt", "error", "replaced")
+
+    def __init__(self):
+        self.text = None
+        self.size = 0
+        self.encoding = None   # None: binary (or not read)
+        self.truncated = False # Less than the whole file is shown
+        self.excerpt = False   # ... as its first and last lines (see read_excerpt)
+        self.error = None      # Message of the error that stopped the read
+        self.replaced = 0      # Invalid byte sequences shown as U+FFFD (streamed UTF-8 only)
+
+
+def read_file_text(full_path, max_bytes=MAX_CONTENT_BYTES, excerpt=None):
+    """
+    Reads at most max_bytes of a file (0 = all of it) as a FileText; excerpt as in
+    read_file_content. The file is opened once: the sniffed head decides binary
+    vs. text and the encoding. Read errors are returned, never raised.
+    """
+    result = FileText()
+    try:
+        with open(full_path, 'rb') as raw:
+            result.encoding = encoding = sniff_encoding(read_counted(raw, SNIFF_BYTES))
+            result.size = size = os.fstat(raw.fileno()).st_size
+            if encoding is None:
+                return result
+            limit = content_limit(size, max_bytes)
+            result.truncated = truncated = limit < size # By bytes, so a file of exactly max_bytes is complete
+            if truncated and excerpt and encoding in EXCERPT_ENCODINGS:
+                result.text, result.encoding = read_excerpt(raw, size, encoding, excerpt[0], excerpt[1], max_bytes)
+                result.excerpt = True
+                return result
+            try:
+                parts = list(iter_file_text(iter_file_bytes(raw, size, limit), encoding, final=not truncated))
+            except UnicodeDecodeError:
+                # Valid UTF-8 in the sniffed window only; re-decode from the same handle
+                result.encoding = 'latin-1'
+                parts = list(iter_file_text(iter_file_bytes(raw, size, limit), 'latin-1'))
+            result.text = "".join(parts)
+    except Exception as e_read: # Permission denied, file removed since the scan, ...
+        metrics.add("errors")
+        result.text = None
+        result.error = str(e_read)
+    return result
+
+
+def _read_file_content(full_path, max_bytes=MAX_CONTENT_BYTES, excerpt=None):
+    # Returns (content, ok); ok is False when content is an error message.
+    read = read_file_text(full_path, max_bytes, excerpt)
+    if read.error is not None:
+        return f"Error reading file: {read.error}", False
+    if read.text is None:
+        return binary_placeholder(read.size), True
+    notes = TRUNCATED_NOTE if read.truncated and not read.excerpt else ""
+    if read.encoding == 'latin-1':
+        notes += LATIN1_NOTE
+    return read.text + notes if notes else read.text, True
+
+
+def language_of(file_rel_path):
+    """ Language of a file from its extension (lang_map.json), or None. """
+    ext = file_suffix(file_rel_path.rpartition('/')[2]).lower()
+    return lang_map.get(ext) or None  # lang_map e global, încărcat o singură dată
+
+def _block_header(file_rel_path):
+    # Determine language hint for markdown code block
+    return f"{file_rel_path}:\n```{language_of(file_rel_path) or ''}\n"
+
+BLOCK_FOOTER = "\n```\n\n"
+
+def format_content_block(file_rel_path, content):
+    """ Returns the output block of one file: its relative path and its content in a code fence. """
+    return f"{_block_header(file_rel_path)}{content if content else '(empty file)'}{BLOCK_FOOTER}"
+
+
+class StreamedBlock:
+    """
+    Output block of a file with more than STREAM_MIN_BYTES to write: instead of
+    being held in memory it is copied to the output chunk by chunk when its turn
+    comes, so memory stays flat whatever the file size. Chunks are already written
+    when a late UTF-8 error shows up, so undecodable bytes are replaced (U+FFFD),
+    counted and noted after the content.
+    Subclasses change what is written around the content (see StreamedRecord).
+    """
+    # Most written after the content (a latin-1 read has nothing to replace)
+    FOOTER_ROOM = len(TRUNCATED_NOTE + REPLACED_NOTE.format(count=sys.maxsize) + BLOCK_FOOTER)
+
+    def __init__(self, full_path, file_rel_path, max_bytes, size=0):
+        self.full_path = full_path
+        self.file_rel_path = file_rel_path
+        self.max_bytes = max_bytes
+        self.content_bytes = content_limit(size, max_bytes) # Expected, for planning output parts
+
+    def _header(self):
+        return _block_header(self.file_rel_path)
+
+    def _escape(self, text):
+        return text
+
+    def _placeholder(self, read):
+        # Content shown instead of a binary file's, or after a read error
+        if read.error is not None:
+            return f"Error reading file: {read.error}"
+        return binary_placeholder(read.size)
+
+    def _footer(self, read):
+        notes = TRUNCATED_NOTE if read.truncated else ""
+        if read.encoding == 'latin-1':
+            notes += LATIN1_NOTE
+        if read.replaced:
+            notes += REPLACED_NOTE.format(count=read.replaced)
+        return notes + BLOCK_FOOTER
+
+    def write_to(self, output_file, max_output=None):
+        """
+        Writes the block and returns its size in UTF-8 bytes (counted only with max_output).
+        With max_output the content is cut (with a note) where the block would exceed max_output bytes.
+        """
+        started = time.perf_counter()
+        written = 0
+        read = FileText() # Filled in as the file is read, for the footer
+        if max_output is not None:
+            # Keep room for what follows the content, which is always written
+            max_output = max(max_output - self.FOOTER_ROOM, 0)
+
+        def write(text):
+            nonlocal written
+            data = self._escape(text)
+            if max_output is not None:
+                nbytes = text_bytes(data)
+                if written + nbytes > max_output:
+                    # Cut on a character boundary at the byte limit (escaping may make it longer)
+                    room = max(max_output - written, 0)
+                    text = text.encode('utf-8')[:room].decode('utf-8', 'ignore')
+                    data = self._escape(text)
+                    while text_bytes(data) > room:
+                        text = text[:len(text) - (text_bytes(data) - room)]
+                        data = self._escape(text)
+                    output_file.write(data)
+                    written += text_bytes(data)
+                    return False
+                written += nbytes
+            output_file.write(data)
+            return True
+
+        header = self._header()
+        output_file.write(header) # Never cut: the block has to be well-formed
+        if max_output is not None:
+            written += text_bytes(header)
+        try:
+            with open(self.full_path, 'rb') as raw:
+                read.encoding = encoding = sniff_encoding(read_counted(raw, SNIFF_BYTES))
+                read.size = size = os.fstat(raw.fileno()).st_size
+                if encoding is None:
+                    write(self._placeholder(read))
+                else:
+                    limit = content_limit(size, self.max_bytes)
+                    read.truncated = limit < size
+                    errors = 'count-replace' if encoding.startswith('utf-8') else 'strict'
+                    _replaced.count = 0
+                    for text in iter_file_text(iter_file_bytes(raw, size, limit), encoding, not read.truncated, errors):
+                        if not write(text):
+                            read.truncated = True
+                            break
+                        if stop_requested:
+                            break
+                    read.replaced = _replaced.count
+        except Exception as e_read: # Permission denied, file removed since the scan, ...
+            metrics.add("errors")
+            read.error = str(e_read)
+            write(self._placeholder(read))
+        footer = self._footer(read)
+        output_file.write(footer)
+        if metrics.slow_files is not None: # Includes writing, which is interleaved with reading
+            metrics.slow_files.record(time.perf_counter() - started, self.file_rel_path, read.size)
+        return written + text_bytes(footer)
+
+
+def get_content_cache_path():
+    """ The content cache is a SQLite file next to the outputs folder. """
+    return os.path.join(os.path.dirname(get_outputs_folder_path()), "content_cache.sqlite3")
+
+
+class ContentCache:
+    """
+    Persistent cache of finished output blocks (see format_content_block), keyed by
+    root folder and relative path and valid while the file's size and mtime_ns match.
+    Blocks written with other content settings (truncation, decoding, language hints)
+    are never served: every block records the format it was made with.
+    The cache is shared by all root folders and kept under max_bytes by dropping
+    the least recently used blocks when it is closed.
+    Lookups and stores may come from several reader threads, and several processes
+    (batch mode) may use the file at once: new blocks are committed batch by batch,
+    so the write lock is only held briefly, and a batch that still cannot be
+    written is dropped rather than failing the run.
+    """
+    FORMAT_VERSION = 4
+    STORE_BATCH = 256
+    BUSY_SECONDS = 30 # How long a write waits for another process holding the lock
+
+    def __init__(self, root_path, db_path=None, max_bytes=512 * 1024 * 1024, max_file_bytes=MAX_CONTENT_BYTES,
+                 excerpt=None):
+        self.root_key = os.path.normcase(os.path.abspath(os.fspath(root_path)))
+        self.db_path = db_path or get_content_cache_path()
+        self.max_bytes = max_bytes
+        self.format_key = self.content_format_key(max_file_bytes, excerpt)
+        self.lock = threading.Lock()
+        self.pending = [] # Blocks read this run, inserted in batches
+        self.touched = [] # Blocks served this run, marked as recently used on close
+        self.hits = 0
+        self.stores = 0
+        self.db = sqlite3.connect(self.db_path, timeout=self.BUSY_SECONDS, check_same_thread=False)
+        try:
+            self.db.execute("PRAGMA auto_vacuum = INCREMENTAL") # Only applies to a new file
+            self.db.execute("PRAGMA journal_mode = WAL") # Readers and a writer do not block each other
+            self.db.execute("PRAGMA synchronous = NORMAL") # Losing the last blocks in a crash is fine
+            self.db.execute("""CREATE TABLE IF NOT EXISTS blocks (
+                root TEXT, rel TEXT, size INTEGER, mtime_ns INTEGER, format TEXT,
+                block TEXT, nbytes INTEGER, used INTEGER, PRIMARY KEY (root, rel))""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS blocks_used ON blocks (used)")
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.close()
+            raise
+
+    @staticmethod
+    def content_format_key(max_file_bytes, excerpt):
+        """ Everything that shapes a block besides the file itself. """
+        langs = json.dumps(lang_map, sort_keys=True)
+        excerpt_key = f"{excerpt[0]},{excerpt[1]}" if excerpt else "-"
+        return f"{ContentCache.FORMAT_VERSION}:{max_file_bytes}:{excerpt_key}:sniff{SNIFF_BYTES}:{hashlib.sha1(langs.encode()).hexdigest()[:12]}"
+
+    def lookup(self, file_rel_path, st):
+        """ Returns the cached block of a file with stat result st, or None. """
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, format, block FROM blocks WHERE root = ? AND rel = ?",
+                                  (self.root_key, file_rel_path)).fetchone()
+            if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns or row[2] != self.format_key:
+                return None
+            self.hits += 1
+            self.touched.append(file_rel_path)
+        return row[3]
+
+    def store(self, file_rel_path, st, block):
+        # A file modified within the timestamp granularity might change again unnoticed
+        if st.st_mtime_ns + ScanIndex.RACY_NS >= time.time_ns():
+            return
+        with self.lock:
+            self.pending.append((self.root_key, file_rel_path, st.st_size, st.st_mtime_ns, self.format_key,
+                                 block, len(block), time.time_ns()))
+            self.stores += 1
+            if len(self.pending) >= self.STORE_BATCH:
+                self._flush()
+
+    def _flush(self):
+        try:
+            self.db.executemany("INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.pending)
+            self.db.commit()
+        except sqlite3.OperationalError: # Locked by another process for too long: these blocks are read again next time
+            self.db.rollback()
+            self.stores -= len(self.pending)
+        self.pending = []
+
+    def close(self):
+        """ Saves new blocks, refreshes the used blocks and evicts down to max_bytes. """
+        with self.lock:
+            try:
+                self._flush()
+                now = time.time_ns()
+                self.db.executemany("UPDATE blocks SET used = ? WHERE root = ? AND rel = ?",
+                                    ((now, self.root_key, rel) for rel in self.touched))
+                self.touched = []
+                total = self.db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM blocks").fetchone()[0]
+                if total > self.max_bytes:
+                    evict = []
+                    for root, rel, nbytes in self.db.execute("SELECT root, rel, nbytes FROM blocks ORDER BY used"):
+                        if total <= self.max_bytes:
+                            break
+                        evict.append((root, rel))
+                        total -= nbytes
+                    self.db.executemany("DELETE FROM blocks WHERE root = ? AND rel = ?", evict)
+                    self.db.commit()
+                    self.db.execute("PRAGMA incremental_vacuum")
+                self.db.commit()
+            finally:
+                self.db.close()
+
+
+def _is_streamed(size, max_bytes, excerpt):
+    # Excerpts are at most max_bytes and are always built in memory
+    if excerpt and max_bytes and size > max_bytes:
+        return False
+    return content_limit(size, max_bytes) > STREAM_MIN_BYTES
+
+
+def read_content_block(root_path, file_rel_path, cache=None, st=None, max_bytes=MAX_CONTENT_BYTES, excerpt=None):
+    """
+    Returns the output block of one file (at most max_bytes of content, 0 = all;
+    excerpt as in read_file_content), served from cache (a ContentCache) when the
+    file is unchanged since it was cached.
+    Contents over STREAM_MIN_BYTES come back as a StreamedBlock instead of a string.
+    st is the file's os.stat() result if the caller already has it.
+    """
+    full_path = root_path / file_rel_path
+    if st is None:
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            pass # Reading reports the error
+    if st is not None and _is_streamed(st.st_size, max_bytes, excerpt):
+        return StreamedBlock(full_path, file_rel_path, max_bytes, st.st_size)
+    if cache is not None and st is not None:
+        block = cache.lookup(file_rel_path, st)
+        if block is not None:
+            metrics.add("cache_hits")
+            return block
+    started = time.perf_counter()
+    content, ok = _read_file_content(full_path, max_bytes, excerpt)
+    block = format_content_block(file_rel_path, content)
+    elapsed = time.perf_counter() - started
+    metrics.add("read_seconds", elapsed)
+    if metrics.slow_files is not None:
+        metrics.slow_files.record(elapsed, file_rel_path, st.st_size if st is not None else 0)
+    if cache is not None and st is not None and ok:
+        cache.store(file_rel_path, st, block)
+    return block
+
+
+# ======================================================================
+# Output Formats (the Markdown-style text, or NDJSON records)
+# ======================================================================
+NDJSON_VERSION = 1 # "version" of the snapshot record; bumped when fields change meaning
+
+def ndjson_line(record):
+    """ One NDJSON record: compact JSON on a single line (newlines inside strings are escaped). """
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n"
+
+def file_record(file_rel_path, st):
+    """ The record fields of a file known from its os.stat() result st (None if it failed). """
+    return {"type": "file", "path": file_rel_path,
+            "size": st.st_size if st is not None else None,
+            "mtime": st.st_mtime if st is not None else None,
+            "language": language_of(file_rel_path)}
+
+def entry_record(full_path, relative_path_str, is_dir):
+    """ Record of a folder, or of a file whose content is not included, as written while scanning. """
+    try:
+        st = os.stat(full_path)
+    except OSError:
+        st = None
+    if is_dir:
+        return ndjson_line({"type": "dir", "path": relative_path_str,
+                            "mtime": st.st_mtime if st is not None else None})
+    return ndjson_line(file_record(relative_path_str, st))
+
+def write_tree_records(output_file, root_path, tree, file_paths):
+    """
+    Writes the entry records of a tree built by scan_tree, each folder before its
+    items (the order stream_tree writes them in); the files in file_paths get their
+    record with the contents instead. Returns the number of items.
+    """
+    root = os.fspath(root_path)
+    content_paths = set(file_paths or ())
+    count = 0
+    stack = [(iter(tree.items()), "")]
+    while stack:
+        items, relative_dir = stack[-1]
+        entry = next(items, None)
+        if entry is None:
+            stack.pop()
+            continue
+        name, subtree = entry
+        relative_path_str = f"{relative_dir}/{name}" if relative_dir else name
+        count += 1
+        if isinstance(subtree, dict):
+            output_file.write(entry_record(os.path.join(root, relative_path_str), relative_path_str, True))
+            stack.append((iter(subtree.items()), relative_path_str))
+        elif relative_path_str not in content_paths:
+            output_file.write(entry_record(os.path.join(root, relative_path_str), relative_path_str, False))
+    return count
+
+
+class StreamedRecord(StreamedBlock):
+    """
+    NDJSON record of a text file with more than STREAM_MIN_BYTES to write, copied to
+    the output chunk by chunk like a StreamedBlock. The content is JSON-escaped on the
+    way, and the fields only known once it is written (encoding, truncated) follow it.
+    """
+    FOOTER_ROOM = 512 # The closing fields (a long error message may take more)
+
+    def __init__(self, full_path, file_rel_path, max_bytes, st):
+        super().__init__(full_path, file_rel_path, max_bytes, st.st_size)
+        self.st = st
+
+    def _header(self):
+        return ndjson_line(file_record(self.file_rel_path, self.st))[:-2] + ',"content":"'
+
+    def _escape(self, text):
+        return json.dumps(text, ensure_ascii=False)[1:-1]
+
+    def _placeholder(self, read):
+        return "" # Binary or unreadable since it was sniffed: the closing fields tell
+
+    def _footer(self, read):
+        fields = {"encoding": read.encoding, "binary": read.error is None and read.encoding is None,
+                  "truncated": read.truncated, "excerpt": False}
+        if read.replaced:
+            fields["replaced"] = read.replaced
+        if read.error is not None:
+            fields["error"] = read.error
+        return '",' + ndjson_line(fields)[1:]
+
+
+def read_file_record(root_path, file_rel_path, st=None, max_bytes=MAX_CONTENT_BYTES, excerpt=None):
+    """
+    NDJSON counterpart of read_content_block: the record of one file with its content
+    (null for binary files and read errors). Text contents over STREAM_MIN_BYTES come
+    back as a StreamedRecord instead of a string.
+    """
+    full_path = root_path / file_rel_path
+    if st is None:
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            pass # Reading reports the error
+    if st is not None and _is_streamed(st.st_size, max_bytes, excerpt):
+        try:
+            with open(full_path, 'rb') as raw:
+                is_text = sniff_encoding(read_counted(raw, SNIFF_BYTES)) is not None
+        except OSError:
+            is_text = False # Reported by read_file_text below
+        if is_text:
+            return StreamedRecord(full_path, file_rel_path, max_bytes, st)
+    started = time.perf_counter()
+    read = read_file_text(full_path, max_bytes, excerpt)
+    record = file_record(file_rel_path, st)
+    record.update({"encoding": read.encoding, "binary": read.error is None and read.encoding is None,
+                   "truncated": read.truncated, "excerpt": read.excerpt, "content": read.text})
+    if read.error is not None:
+        record["error"] = read.error
+    elapsed = time.perf_counter() - started
+    metrics.add("read_seconds", elapsed)
+    if metrics.slow_files is not None:
+        metrics.slow_files.record(elapsed, file_rel_path, st.st_size if st is not None else 0)
+    return ndjson_line(record)
+
+
+class TextFormat:
+    """
+    The default output: the hierarchy drawn as a tree, then the content of each
+    file in a Markdown code fence. A format holds what the writers leave to it.
+    """
+    extension = ".txt"
+    records = False # One JSON record per line (see NdjsonFormat)
+    header_lines = 2 # A block opens with its path and the code fence
+    contents_header = "Contents of files:\n\n"
+    no_contents = "Contents of files:\n\n(No files selected or found to include content)\n\n"
+    contents_skipped = "File contents skipped in 'No Content' mode.\n"
+    stopped_note = "\n--- OPERATION STOPPED ---\n"
+    interrupted_note = "\n\n--- GENERATION INTERRUPTED ---\n"
+
+    def read_block(self, root_path, file_rel_path, cache, st, max_bytes, excerpt):
+        return read_content_block(root_path, file_rel_path, cache, st, max_bytes, excerpt)
+
+    def duplicate_block(self, root_path, file_rel_path, original_rel_path):
+        return format_content_block(file_rel_path, duplicate_placeholder(original_rel_path))
+
+    def limit_note(self, count, max_output_bytes):
+        return f"... ({count} more files not included: output limit of {max_output_bytes:,} bytes reached)\n"
+
+
+class NdjsonFormat:
+    """
+    Newline-delimited JSON, one record per line: a "snapshot" record, a record per
+    folder and file as they are scanned, the records of the files whose content is
+    included, then an "end" record (an "interrupted" one if the run was stopped).
+    """
+    extension = ".ndjson"
+    records = True
+    header_lines = 0 # A record is a single line
+    contents_header = no_contents = contents_skipped = stopped_note = ""
+    interrupted_note = ndjson_line({"type": "interrupted"})
+
+    def snapshot_record(self, root_path, mode):
+        return ndjson_line({"type": "snapshot", "version": NDJSON_VERSION, "root": str(root_path),
+                            "name": root_path.name, "mode": mode,
+                            "created": datetime.datetime.now().isoformat(timespec='seconds')})
+
+    def end_record(self):
+        return ndjson_line({"type": "end", "dirs": metrics.values["dirs"],
+                            "content_files": metrics.values["content_files"]})
+
+    def read_block(self, root_path, file_rel_path, cache, st, max_bytes, excerpt):
+        # The content cache holds text blocks, so records are always read
+        return read_file_record(root_path, file_rel_path, st, max_bytes, excerpt)
+
+    def duplicate_block(self, root_path, file_rel_path, original_rel_path):
+        try:
+            st = os.stat(root_path / file_rel_path)
+        except OSError:
+            st = None
+        record = file_record(file_rel_path, st)
+        record["duplicate_of"] = original_rel_path
+        return ndjson_line(record)
+
+    def limit_note(self, count, max_output_bytes):
+        return ndjson_line({"type": "limit", "files_not_included": count, "max_output_bytes": max_output_bytes})
+
+
+OUTPUT_FORMATS = {"text": TextFormat(), "ndjson": NdjsonFormat()}
+
+def output_format():
+    """ The output_format setting as an OUTPUT_FORMATS value. """
+    name = str(settings["output_format"] or "text").lower()
+    if name not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output_format '{name}' (use text or ndjson).")
+    return OUTPUT_FORMATS[name]
+
+
+class ByteBudget:
+    """
+    Bounds the bytes held by file contents that were read ahead but not written yet.
+    The file the writer needs next may always proceed, even over budget,
+    so the pipeline can never deadlock on one large file.
     """
-    Writes the content of each file (within triple backticks) to the output file.
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.next_index = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def acquire(self, index, nbytes):
+        with self.cond:
+            while not self.closed and index != self.next_index and self.used + nbytes > self.limit:
+                self.cond.wait()
+            self.used += nbytes
+
+    def release(self, nbytes, next_index):
+        with self.cond:
+            self.used -= nbytes
+            self.next_index = next_index
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+def _prefetch_file_content(root_path, file_rel_path, index, budget, cache, max_bytes, excerpt, fmt):
+    # Runs on a reader thread; charge the budget before the content is in memory
+    try:
+        st = os.stat(root_path / file_rel_path)
+        charge = content_limit(st.st_size, max_bytes)
+        if _is_streamed(st.st_size, max_bytes, excerpt):
+            charge = 0 # Streamed by the writer, never held in memory
+    except OSError:
+        st = None
+        charge = 0
+    budget.acquire(index, charge)
+    if stop_requested or budget.closed:
+        return "", charge
+    return fmt.read_block(root_path, file_rel_path, cache, st, max_bytes, excerpt), charge
+
+
+DEDUPE_MIN_BYTES = 256        # Smaller files are written even when repeated; a reference would save little
+HASH_HEAD_BYTES = 64 * 1024   # Same-size files are first told apart by a hash of their start
+STAT_BATCH_FILES = 512        # Files stat'ed per task when collecting sizes
+
+def hash_file(full_path, limit=None):
+    """ BLAKE2b digest of the first limit bytes of a file (None = all of it), or None if it cannot be read. """
+    digest = hashlib.blake2b(digest_size=20)
+    try:
+        with open(full_path, 'rb') as raw:
+            remaining = limit
+            while remaining is None or remaining > 0:
+                data = read_counted(raw, CHUNK_BYTES if remaining is None else min(CHUNK_BYTES, remaining))
+                if not data or stop_requested:
+                    break
+                digest.update(data)
+                if remaining is not None:
+                    remaining -= len(data)
+    except OSError:
+        return None # Reading the file for its block reports the error
+    return digest.digest()
+
+def find_duplicate_files(root_path, file_paths, workers=1):
+    """
+    Returns {file_rel_path: rel path of the first file in file_paths with the same content}
+    for every later copy. Files are grouped by size first (files under DEDUPE_MIN_BYTES
+    are left out); only sizes shared by several files are hashed, on `workers` threads:
+    their first HASH_HEAD_BYTES, then the whole file for those that still match.
+    """
+    def stat_sizes(batch):
+        sizes = []
+        for file_rel_path in batch:
+            try:
+                sizes.append(os.stat(os.path.join(root_path, file_rel_path)).st_size)
+            except OSError:
+                sizes.append(-1)
+        return sizes
+
+    def split_by_hash(groups, limit):
+        # groups: lists of paths that may be identical -> the lists still matching by hash
+        paths = [file_rel_path for group in groups for file_rel_path in group]
+        digests = dict(zip(paths, executor.map(lambda rel: hash_file(root_path / rel, limit), paths)))
+        matching = []
+        for group in groups:
+            by_digest = {}
+            for file_rel_path in group:
+                if digests[file_rel_path] is not None:
+                    by_digest.setdefault(digests[file_rel_path], []).append(file_rel_path)
+            matching += [same for same in by_digest.values() if len(same) > 1]
+        return matching
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="dedupe") as executor:
+        by_size = {}
+        batches = [file_paths[i:i + STAT_BATCH_FILES] for i in range(0, len(file_paths), STAT_BATCH_FILES)]
+        sizes = (size for batch_sizes in executor.map(stat_sizes, batches) for size in batch_sizes)
+        for file_rel_path, size in zip(file_paths, sizes):
+            if size >= DEDUPE_MIN_BYTES:
+                by_size.setdefault(size, []).append(file_rel_path)
+        small = [group for size, group in by_size.items() if len(group) > 1 and size <= HASH_HEAD_BYTES]
+        large = [group for size, group in by_size.items() if len(group) > 1 and size > HASH_HEAD_BYTES]
+        groups = split_by_hash(small, None) # The head is the whole file
+        if large and not stop_requested:
+            groups += split_by_hash(split_by_hash(large, HASH_HEAD_BYTES), None)
+
+    duplicates = {}
+    for group in groups: # Each group keeps the file_paths order, so the first one is written in full
+        for file_rel_path in group[1:]:
+            duplicates[file_rel_path] = group[0]
+    return duplicates
+
+
+def iter_file_contents(root_path, file_paths, workers=1, prefetch_files=64, buffer_bytes=64 * 1024 * 1024,
+                       cache=None, max_file_bytes=MAX_CONTENT_BYTES, excerpt=None, duplicates=None,
+                       fmt=OUTPUT_FORMATS["text"]):
+    """
+    Yields (file_rel_path, block) in file_paths order, block being the file's
+    finished output or a StreamedBlock (see read_content_block; cache is an
+    optional ContentCache, max_file_bytes the per-file cap, excerpt the
+    (head_lines, tail_lines) shown of larger files). fmt (see OUTPUT_FORMATS)
+    reads the blocks.
+    Files in duplicates (see find_duplicate_files) are not read; their block
+    names the earlier file with the same content.
+    With more than one worker, up to prefetch_files files are read and decoded
+    ahead of the writer on a thread pool, holding at most ~buffer_bytes in memory.
+    """
+    duplicates = duplicates or {}
+    if workers <= 1:
+        for file_rel_path in file_paths:
+            original = duplicates.get(file_rel_path)
+            if original is not None:
+                yield file_rel_path, fmt.duplicate_block(root_path, file_rel_path, original)
+                continue
+            yield file_rel_path, fmt.read_block(root_path, file_rel_path, cache, None, max_file_bytes, excerpt)
+        return
+
+    budget = ByteBudget(buffer_bytes)
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="read")
+    pending = iter(enumerate(file_paths))
+    window = deque()
+
+    def fill_window():
+        while len(window) < prefetch_files:
+            nxt = next(pending, None)
+            if nxt is None:
+                return
+            index, file_rel_path = nxt
+            original = duplicates.get(file_rel_path)
+            if original is not None:
+                future = Future()
+                future.set_result((fmt.duplicate_block(root_path, file_rel_path, original), 0))
+            else:
+                future = executor.submit(_prefetch_file_content, root_path, file_rel_path, index, budget, cache,
+                                         max_file_bytes, excerpt, fmt)
+            window.append((file_rel_path, future))
+
+    try:
+        fill_window()
+        written = 0
+        while window:
+            file_rel_path, future = window.popleft()
+            started = time.perf_counter()
+            content, charge = future.result()
+            metrics.add("wait_seconds", time.perf_counter() - started)
+            yield file_rel_path, content
+            written += 1
+            budget.release(charge, written)
+            fill_window()
+    finally:
+        # Also runs when the writer stops early (generator closed)
+        budget.close()
+        for _, future in window:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def write_file_contents(output_file, root_path, file_paths, status_callback,
+                        read_workers=1, prefetch_files=64, buffer_bytes=64 * 1024 * 1024, cache=None,
+                        max_file_bytes=MAX_CONTENT_BYTES, max_output_bytes=0, excerpt=None, duplicates=None,
+                        fmt=OUTPUT_FORMATS["text"]):
+    """
+    Writes the content of each file (within triple backticks, or as records with
+    fmt = OUTPUT_FORMATS["ndjson"]) to the output file.
+    Files are read by iter_file_contents, in parallel when read_workers > 1,
+    and always written in file_paths order. Unchanged files come from cache
+    (a ContentCache) when one is given.
+    At most max_file_bytes of each file are written (0 = whole files); with
+    excerpt = (head_lines, tail_lines) larger files show their first and last lines. With
+    max_output_bytes > 0, writing ends before the file blocks would exceed that
+    many UTF-8 bytes; the remaining files are counted in a closing note.
+    Files in duplicates (see find_duplicate_files) are written as a reference
+    to the earlier file with the same content.
+    A ShardedOutput or TrackedOutput as output_file is told where each block starts and ends.
     Checks stop_requested flag periodically.
     Handles empty file_paths list gracefully.
     """
     global stop_requested
     if not file_paths:
-        output_file.write("Contents of files:\n\n(No files selected or found to include content)\n\n")
+        output_file.write(fmt.no_contents)
         safe_update(status_callback, "Skipping file content writing (no files selected).")
         return True # Nothing to write, but not an error or stop
 
     safe_update(status_callback, "Writing file contents...")
-    output_file.write("Contents of files:\n\n")
+    output_file.write(fmt.contents_header)
     total_files = len(file_paths)
-    for i, file_rel_path in enumerate(file_paths):
-        if stop_requested:
-            safe_update(status_callback, "Operation stopped during file writing.")
-            output_file.write("\n--- OPERATION STOPPED ---\n")
-            return False # Indicate stop
-
-        safe_update(status_callback, f"Writing content: {file_rel_path} ({i+1}/{total_files})")
-        output_file.write(f"{file_rel_path}:\n")
-
-        # Determine language hint for markdown code block
-        ext = Path(file_rel_path).suffix.lower()
-        lang_hint = lang_map.get(ext, '')  # lang_map e global, încărcat o singură dată
-
-        output_file.write(f"```{lang_hint}\n")
-        full_path = root_path / file_rel_path
-        content = ""
-        try:
-            # Try reading with UTF-8 first, fallback to latin-1 for binary/other files
-            try:
-                with open(full_path, 'r', encoding='utf-8') as f:
-                    content = f.read(1024 * 1024) # Read up to 1MB to prevent memory issues with huge files
-                    if len(content) == 1024 * 1024:
-                         content += "\n... (file content truncated due to size)"
-            except UnicodeDecodeError:
-                 try:
-                     with open(full_path, 'r', encoding='latin-1') as f:
-                         content = f.read(1024 * 1024) # Read up to 1MB
-                         if len(content) == 1024 * 1024:
-                              content += "\n... (file content truncated due to size)"
-                         content += "\n... (Note: Read using latin-1 encoding)"
-                 except Exception as e_latin1:
-                     content = f"Error reading file (latin-1 fallback failed): {e_latin1}"
-            except Exception as e_read: # Catch other file reading errors like permission denied
-                 content = f"Error reading file: {e_read}"
-
-        except FileNotFoundError:
-             content = f"Error: File not found at path '{full_path}' (maybe moved/deleted during scan?)"
-        except Exception as e:
-            content = f"Error accessing file: {e}"
-            traceback.print_exc()
-
-        output_file.write(content if content else "(empty file)")
-        output_file.write("\n```\n\n")
+    written = 0 # UTF-8 bytes of file blocks, counted only with max_output_bytes
+    tracked = output_file if isinstance(output_file, (ShardedOutput, TrackedOutput)) else None
+    contents = iter_file_contents(root_path, file_paths, read_workers, prefetch_files, buffer_bytes,
+                                  cache, max_file_bytes, excerpt, duplicates, fmt)
+    try:
+        for i, (file_rel_path, block) in enumerate(contents):
+            if stop_requested:
+                safe_update(status_callback, "Operation stopped during file writing.")
+                output_file.write(fmt.stopped_note)
+                return False # Indicate stop
+
+            if max_output_bytes:
+                nbytes = 0 if isinstance(block, StreamedBlock) else len(block.encode('utf-8'))
+                if written >= max_output_bytes or written + nbytes > max_output_bytes:
+                    output_file.write(fmt.limit_note(total_files - i, max_output_bytes))
+                    safe_update(status_callback, f"Output limit reached; {total_files - i} files not included.")
+                    break
+                written += nbytes
+
+            metrics.add("content_files")
+            report_progress(status_callback, metrics.content_progress(file_rel_path, i + 1, total_files))
+            if tracked is not None:
+                if isinstance(block, StreamedBlock): # Line count unknown until it is written
+                    tracked.start_block(file_rel_path, block.content_bytes, None, fmt.header_lines)
+                else:
+                    tracked.start_block(file_rel_path, text_bytes(block), block.count("\n"), fmt.header_lines)
+            if isinstance(block, StreamedBlock):
+                # Copied chunk by chunk, within what is left of the output limit
+                written += block.write_to(output_file, max_output_bytes - written if max_output_bytes else None)
+                if tracked is not None:
+                    tracked.end_block()
+                if stop_requested:
+                    safe_update(status_callback, "Operation stopped during file writing.")
+                    output_file.write(fmt.stopped_note)
+                    return False
+            else:
+                output_file.write(block)
+                if tracked is not None:
+                    tracked.end_block()
+    finally:
+        contents.close()
 
     return True # Indicate success
 
@@ -545,9 +2064,16 @@ def write_file_contents(output_file, root_path, file_paths, status_callback):
 # WORKER THREAD & UI SAFETY HELPERS (from example)
 # ============================================================================
 def safe_update(callback, *args):
-    """ Safely schedule a GUI update from a background thread. """
+    """
+    Safely schedule a GUI update from a background thread.
+    In headless (command-line) runs the callback is simply called.
+    """
     global app # Use the global app reference
-    if app: # Ensure app exists and hasn't been destroyed
+    if callback is None:
+        return
+    if headless or isinstance(callback, ProgressChannel):
+        callback(*args)
+    elif app: # Ensure app exists and hasn't been destroyed
         try:
             # Check if the widget associated with the callback still exists
             # This is a basic check; specific widgets might need more care
@@ -562,10 +2088,1701 @@ def safe_update(callback, *args):
             # print(f"Safe update failed: {e}") # Uncomment for debugging if needed
             pass
 
+
+def report_progress(callback, message):
+    """
+    safe_update for frequent progress messages (one per file or folder):
+    a ProgressChannel keeps only the latest one until the GUI shows it.
+    """
+    if isinstance(callback, ProgressChannel):
+        callback.set_progress(message)
+    else:
+        safe_update(callback, message)
+
+
+class ProgressChannel:
+    """
+    Status channel from the generation thread to the GUI, used as its status_callback.
+    Posting never touches Tk: log messages are queued (at most max_messages, the
+    oldest are dropped first) and progress messages only keep the latest one.
+    The GUI drains the channel at a fixed rate (see FileTreeBuilderApp._poll_progress).
+    """
+    def __init__(self, max_messages=1000):
+        self.lock = threading.Lock()
+        self.messages = deque(maxlen=max_messages)
+        self.dropped = 0
+        self.progress = None
+
+    def __call__(self, message):
+        timestamp = datetime.datetime.now().strftime("%H:%M:%S")
+        with self.lock:
+            if len(self.messages) == self.messages.maxlen:
+                self.dropped += 1
+            self.messages.append((timestamp, message))
+
+    def set_progress(self, message):
+        with self.lock:
+            self.progress = message
+
+    def drain(self):
+        """ Returns (messages, dropped, progress) posted since the last drain; progress may be None. """
+        with self.lock:
+            messages = list(self.messages)
+            self.messages.clear()
+            dropped, self.dropped = self.dropped, 0
+            progress, self.progress = self.progress, None
+        return messages, dropped, progress
+
+# ======================================================================
+# Generation Pipeline (shared by the GUI and the command line)
+# ======================================================================
+def parse_filters(filter_string):
+    # Patterns are kept as typed; PatternMatcher compiles globs like '*.egg-info'
+    if not filter_string:
+        return set()
+    filters = set()
+    for item in filter_string.split('|'):
+        item = item.strip()
+        if not item:
+             continue
+        filters.add(item)
+    return filters
+
+def parse_extensions(ext_string):
+    extensions = set()
+    if not ext_string:
+        return extensions
+    for ext in ext_string.split('|'):
+        ext = ext.strip().lower()
+        if ext:
+            if not ext.startswith('.'):
+                ext = '.' + ext
+            extensions.add(ext)
+    return extensions
+
+def build_rules(mode, root_path, ignore_items="", ignore_exts="", target_items="", target_exts="",
+                use_gitignore=False, status_callback=None):
+    """
+    Parses the pipe-separated filter fields used by `mode` and returns the rules
+    object for scan_tree (ClassicRules or TargetRules, wrapped in GitignoreRules if asked).
+    """
+    # Parse ignore filters for Classic and No Content modes
+    if mode == "Classic" or mode == "No Content":
+        all_ignored = parse_filters(ignore_items).union(parse_extensions(ignore_exts))
+        if mode == "Classic":
+            safe_update(status_callback, f"Classic Mode: Ignoring {len(all_ignored)} patterns.")
+        else: # No Content mode
+            safe_update(status_callback, f"No Content Mode: Applying {len(all_ignored)} ignore patterns to hierarchy.")
+        rules = ClassicRules(all_ignored)
+
+    # Parse target filters for Target mode
+    elif mode == "Target":
+        target_extensions = parse_extensions(target_exts)
+        target_folders, target_files = split_target_items(parse_filters(target_items), root_path)
+        safe_update(status_callback, f"Target Mode: Targeting {len(target_folders)} folders, {len(target_files)} files, {len(target_extensions)} extensions.")
+        rules = TargetRules(target_folders, target_files, target_extensions)
+    else:
+        raise ValueError(f"Unknown mode: {mode}")
+
+    if use_gitignore:
+        rules = GitignoreRules(rules, root_path)
+    return rules
+
+# output_compression setting -> (file suffix, opener of a compressing binary stream on an open file)
+OUTPUT_COMPRESSION = {
+    "gzip": (".gz", lambda raw: gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6)),
+    "xz": (".xz", lambda raw: lzma.LZMAFile(raw, 'wb')),
+    "bz2": (".bz2", lambda raw: bz2.BZ2File(raw, 'wb')),
+}
+OUTPUT_BUFFER_BYTES = 1024 * 1024 # Text written to a compressed output is handed over in chunks of this size
+COMPRESS_QUEUE_CHUNKS = 16        # Chunks waiting for the compressor thread (bounds memory)
+OUTPUT_DECOMPRESSION = {"gzip": gzip.open, "xz": lzma.open, "bz2": bz2.open} # Readers of compressed outputs
+
+def output_compression():
+    """ The output_compression setting as an OUTPUT_COMPRESSION key, or None for plain text. """
+    name = str(settings["output_compression"] or "none").lower()
+    if name == "none":
+        return None
+    if name not in OUTPUT_COMPRESSION:
+        raise ValueError(f"Unknown output_compression '{name}' (use none, gzip, xz or bz2).")
+    return name
+
+
+class CompressingWriter(io.RawIOBase):
+    """
+    Binary sink of a compressed output file. write() only queues the bytes; a
+    separate thread compresses them (zlib, lzma and bz2 release the GIL while
+    working), so compression overlaps with scanning and reading instead of
+    adding to the writer's time. The queue is bounded, so a slow compressor
+    holds the writer back rather than piling up memory.
+    """
+    def __init__(self, path, compression, mode='w'):
+        self.raw = open(path, mode + 'b') # 'a' adds a new stream, which gzip/xz/bz2 readers continue into
+        self.stream = OUTPUT_COMPRESSION[compression][1](self.raw)
+        self.queue = queue.Queue(COMPRESS_QUEUE_CHUNKS)
+        self.error = None
+        self.thread = threading.Thread(target=self._compress, daemon=True)
+        self.thread.start()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.error is not None:
+            raise OSError(f"Compressing the output failed: {self.error}")
+        data = bytes(data) # The caller may reuse its buffer
+        self.queue.put(data)
+        return len(data)
+
+    def _compress(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error is None: # After an error keep draining, so write() never blocks
+                try:
+                    self.stream.write(data)
+                except Exception as e:
+                    self.error = e
+
+    def close(self):
+        if self.closed:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            self.stream.close()
+        finally:
+            self.raw.close()
+            super().close()
+        if self.error is not None:
+            raise OSError(f"Compressing the output failed: {self.error}")
+
+
+def open_output(output_file_path, compression=None, mode='w'):
+    """ Opens the output file for writing text, through a CompressingWriter if compression is set. """
+    if compression is None:
+        return open(output_file_path, mode, encoding='utf-8')
+    buffered = io.BufferedWriter(CompressingWriter(output_file_path, compression, mode), OUTPUT_BUFFER_BYTES)
+    return io.TextIOWrapper(buffered, encoding='utf-8')
+
+def output_stem(output_file_path):
+    """ Output file name without .txt, the compression suffix and the first part's number (x_part001.txt.gz -> x). """
+    name = output_file_path.name
+    for suffix, _ in OUTPUT_COMPRESSION.values():
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    stem = Path(name).stem
+    return stem[:-len(FIRST_PART)] if stem.endswith(FIRST_PART) else stem
+
+FIRST_PART = "_part001"
+
+def output_sidecar_path(output_file_path, suffix):
+    """
+    <output name><suffix> next to the output file, without the first part's number
+    (x_part001.txt.gz -> x.txt.gz<suffix>). The whole name is kept, so the outputs of
+    one root in another format or compression do not share their sidecar files.
+    """
+    name = output_file_path.name
+    stem = output_stem(output_file_path)
+    if name.startswith(stem + FIRST_PART):
+        name = stem + name[len(stem) + len(FIRST_PART):]
+    return output_file_path.with_name(name + suffix)
+
+def shard_path(first_part_path, number):
+    """ Path of part `number` of a sharded output, from the path of its first part (x_part001.txt -> x_part002.txt). """
+    return first_part_path.with_name(first_part_path.name.replace(FIRST_PART, f"_part{number:03d}", 1))
+
+def manifest_path(output_file_path):
+    """ <output name>.manifest.json, next to the output file (x_part001.txt -> x.txt.manifest.json). """
+    return output_sidecar_path(output_file_path, ".manifest.json")
+
+def text_bytes(text):
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
+
+
+class ShardedOutput:
+    """
+    Text output split over <name>_part001.txt, <name>_part002.txt, ... of at most
+    max_bytes UTF-8 bytes and max_lines lines each (0 = no limit). The hierarchy
+    goes in the first part. write_file_contents calls start_block() before every
+    file block, which moves to a new part when the block would not fit in this one,
+    so a block is only split when it alone is over the budget: then write() moves
+    on at a line end once the part is full (never inside a line, so a part of an
+    NDJSON output only holds whole records), and the file is listed in every part it spans.
+    A line over the budget on its own is not split either, so its part can exceed
+    max_bytes / max_lines; it stays with the block header before it rather than
+    leaving a part that only holds the header.
+    On close a manifest (see manifest_path) lists the files of each part.
+    """
+    def __init__(self, first_part_path, root_path, mode, compression=None, max_bytes=0, max_lines=0):
+        self.first_part_path = first_part_path
+        self.root_path = root_path
+        self.mode = mode
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.parts = [] # Manifest entries
+        self.file = None
+        self.block = None # File whose block is being written
+        self.block_owns_part = False # The part holds nothing before the current block
+        self.line_open = False # The last write did not end a line
+        self.header_lines = 0 # Lines the current block opens with (its header), never left alone in a part
+        self.block_lines = 0 # Lines of the current block written to this part
+        self._next_part()
+
+    @property
+    def path(self):
+        """ Path of the part being written. """
+        return self.first_part_path.with_name(self.part["file"])
+
+    def _next_part(self):
+        if self.file is not None:
+            self.file.close()
+        path = shard_path(self.first_part_path, len(self.parts) + 1)
+        self.file = open_output(path, self.compression)
+        self.part = {"file": path.name, "bytes": 0, "lines": 0, "files": []}
+        self.parts.append(self.part)
+        self.header_lines = self.block_lines = 0 # A block going on here left its header behind
+
+    def _over_budget(self, nbytes, nlines):
+        return ((self.max_bytes and self.part["bytes"] + nbytes > self.max_bytes) or
+                (self.max_lines and self.part["lines"] + nlines > self.max_lines))
+
+    def start_block(self, file_rel_path, nbytes, nlines, header_lines=0):
+        """
+        Starts the block of a file of about nbytes and nlines (None = unknown, assume
+        a whole part), whose first header_lines lines are its header.
+        """
+        if nlines is None:
+            nlines = self.max_lines
+        if self.part["bytes"] and self._over_budget(nbytes, nlines):
+            self._next_part()
+        self.block = str(file_rel_path).replace(os.sep, '/')
+        self.block_owns_part = not self.part["bytes"]
+        self.header_lines = header_lines
+        self.block_lines = 0
+        self.part["files"].append(self.block)
+
+    def end_block(self):
+        self.block = None
+        self.block_owns_part = False
+        self.header_lines = 0
+
+    def _fitting_prefix(self, text):
+        """ Length of the longest start of text that ends a line and still fits in this part. """
+        end = len(text)
+        if self.max_lines:
+            pos = -1
+            for _ in range(max(self.max_lines - self.part["lines"], 0)):
+                pos = text.find("\n", pos + 1)
+                if pos < 0:
+                    break
+            else:
+                end = pos + 1
+        room = self.max_bytes - self.part["bytes"]
+        if self.max_bytes:
+            end = min(end, max(room, 0)) # Characters take at least one byte each
+        cut = text.rfind("\n", 0, end) + 1
+        while self.max_bytes and cut and text_bytes(text[:cut]) > room:
+            cut = text.rfind("\n", 0, cut - 1) + 1
+        return cut
+
+    def _write(self, text):
+        self.file.write(text)
+        self.part["bytes"] += text_bytes(text)
+        self.part["lines"] += text.count("\n")
+        if text:
+            self.line_open = not text.endswith("\n")
+        if self.block is not None:
+            self.block_lines += text.count("\n")
+
+    def write(self, text):
+        # A block over budget on its own is split: fill this part up to a line end, go on in the next
+        while self.block is not None and self.block_owns_part and self._over_budget(text_bytes(text), text.count("\n")):
+            cut = self._fitting_prefix(text)
+            if self.block_lines + text.count("\n", 0, cut) <= self.header_lines:
+                cut = 0 # Only the header would be left in this part: keep the next line with it
+            if not cut and (self.block_lines <= self.header_lines or self.line_open):
+                break # Not even one line fits (after the header), or the line started here goes on
+            self._write(text[:cut])
+            text = text[cut:]
+            self._next_part()
+            self.part["files"].append(self.block)
+        self._write(text)
+        return len(text)
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        manifest = {"root": str(self.root_path), "mode": self.mode,
+                    "max_bytes": self.max_bytes, "max_lines": self.max_lines, "parts": self.parts}
+        with open(manifest_path(self.first_part_path), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        metrics.values["bytes_written"] = sum(self.first_part_path.with_name(part["file"]).stat().st_size
+                                              for part in self.parts)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TrackedOutput:
+    """
+    Text output that counts the bytes it writes and keeps where each file block
+    starts and ends (write_file_contents calls start_block / end_block), as
+    {file_rel_path: (start, end)} byte offsets in blocks. Offsets are those of the
+    text as written, so for a compressed output they are offsets in the uncompressed text.
+    """
+    def __init__(self, file, blocks):
+        self.file = file
+        self.blocks = blocks
+        self.offset = 0
+        self.block = None
+        self.block_start = 0
+        self.newline_extra = len(os.linesep) - 1 # Text files write '\n' as os.linesep
+
+    def start_block(self, file_rel_path, nbytes, nlines, header_lines=0):
+        self.block = file_rel_path
+        self.block_start = self.offset
+
+    def end_block(self):
+        if self.block is not None:
+            self.blocks[self.block] = (self.block_start, self.offset)
+            self.block = None
+
+    def write(self, text):
+        self.file.write(text)
+        self.offset += text_bytes(text)
+        if self.newline_extra:
+            self.offset += self.newline_extra * text.count("\n")
+        return len(text)
+
+    def close(self):
+        self.end_block()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def block_index_path(output_file_path):
+    """ <output name>.blocks.json, next to the output file (see output_sidecar_path). """
+    return output_sidecar_path(output_file_path, ".blocks.json")
+
+
+class BlockIndex:
+    """
+    Sidecar of a single-file output (see block_index_path) with the byte offset and
+    length of its hierarchy section and of every file block, as counted by a
+    TrackedOutput. read() gets a block back with one seek instead of scanning the
+    output for its header; for a compressed output the offsets are in the
+    uncompressed text, which is decompressed up to the block.
+    The name, size and mtime of the output are recorded too, so the index of another
+    output or one left over from an earlier output is refused instead of returning
+    the wrong bytes.
+    """
+    VERSION = 1
+
+    def __init__(self, output_file_path, hierarchy=None, blocks=None, compression=None):
+        self.output_file_path = Path(output_file_path)
+        self.hierarchy = hierarchy # (start, end) of the hierarchy section, or None
+        self.blocks = blocks if blocks is not None else {} # {file_rel_path: (start, end)}
+        self.compression = compression
+
+    def save(self):
+        """ Writes the index of the output as it is now (replacing the previous one atomically). """
+        st = os.stat(self.output_file_path)
+        data = {"version": self.VERSION, "output": self.output_file_path.name, "compression": self.compression,
+                "output_size": st.st_size, "output_mtime_ns": st.st_mtime_ns,
+                "hierarchy": [self.hierarchy[0], self.hierarchy[1] - self.hierarchy[0]] if self.hierarchy else None,
+                "blocks": {file_rel_path: [start, end - start] for file_rel_path, (start, end) in self.blocks.items()}}
+        index_path = block_index_path(self.output_file_path)
+        temp_path = atomic_temp_path(index_path)
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_path, index_path)
+
+    @classmethod
+    def load(cls, output_file_path, verify=True):
+        """
+        Loads the index of an output. Raises OSError if there is none, ValueError if it is
+        not a block index, belongs to another output or (with verify) the output changed
+        since it was written.
+        """
+        output_file_path = Path(output_file_path)
+        index_path = block_index_path(output_file_path)
+        with open(index_path, encoding='utf-8') as f:
+            data = json.load(f)
+        if not isinstance(data, dict) or data.get("version") != cls.VERSION:
+            raise ValueError(f"{index_path.name} is not a block index this version can read.")
+        if data["output"] != output_file_path.name:
+            raise ValueError(f"{index_path.name} is the block index of {data['output']}, not of {output_file_path.name}.")
+        if verify:
+            st = os.stat(output_file_path)
+            if (st.st_size, st.st_mtime_ns) != (data["output_size"], data["output_mtime_ns"]):
+                raise ValueError(f"{index_path.name} is out of date: {output_file_path.name} changed since it was written.")
+        hierarchy = data["hierarchy"]
+        blocks = {file_rel_path: (start, start + length) for file_rel_path, (start, length) in data["blocks"].items()}
+        return cls(output_file_path, (hierarchy[0], hierarchy[0] + hierarchy[1]) if hierarchy else None,
+                   blocks, data["compression"])
+
+    def read(self, file_rel_path=None):
+        """ The bytes of a file's block (None: the hierarchy section); KeyError if it is not in the index. """
+        if file_rel_path is None:
+            if self.hierarchy is None:
+                raise KeyError("hierarchy")
+            start, end = self.hierarchy
+        else:
+            start, end = self.blocks[file_rel_path]
+        if self.compression is None:
+            f = open(self.output_file_path, 'rb')
+        else:
+            f = OUTPUT_DECOMPRESSION[self.compression](self.output_file_path, 'rb')
+        with f:
+            f.seek(start)
+            return f.read(end - start)
+
+
+def extract_block(output_file_path, file_rel_path=None):
+    """
+    The block of one file (None: the hierarchy section) of an output written with
+    block_index, as text, read with one seek (see BlockIndex).
+    """
+    return BlockIndex.load(output_file_path).read(file_rel_path).decode('utf-8')
+
+
+def save_block_index(output_file_path, hierarchy, blocks, compression, status_callback):
+    """ Writes the BlockIndex of a finished output; failing to write it never fails the run. """
+    try:
+        BlockIndex(output_file_path, hierarchy, blocks, compression).save()
+    except OSError as e:
+        safe_update(status_callback, f"Could not write block index: {e}")
+
+def unique_output_path(output_dir, folder_name, mode, status_callback=None, extension=".txt"):
+    """ Returns a not yet existing output path in output_dir for this folder and mode. """
+    # Add mode to filename for clarity, especially for No Content
+    base_filename = f"{folder_name}_hierarchy_{mode.lower().replace(' ', '')}{extension}"
+    output_file_path = output_dir / base_filename
+
+    counter = 1
+    while output_file_path.exists():
+        now_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        new_filename = f"{folder_name}_hierarchy_{mode.lower().replace(' ', '')}_{now_str}{extension}"
+        output_file_path = output_dir / new_filename
+        counter += 1
+        if counter > 20:
+            safe_update(status_callback, "Error: Could not create unique output filename after multiple attempts.")
+            raise IOError("Could not find a unique filename.")
+    return output_file_path
+
+def save_scan_index(index, status_callback):
+    """ Saves a ScanIndex after a complete scan; failing to save never fails the run. """
+    if index is None:
+        return
+    safe_update(status_callback, f"Scan index: {index.reused} of {len(index.new)} folders unchanged since the last run.")
+    try:
+        index.save()
+    except OSError as e:
+        safe_update(status_callback, f"Could not save scan index: {e}")
+
+
+def open_content_cache(root_path, max_file_bytes, excerpt, status_callback):
+    """ Returns a ContentCache when enabled in settings; a cache that cannot be opened is skipped. """
+    if not settings["content_cache"]:
+        return None
+    try:
+        return ContentCache(root_path, max_bytes=int(settings["content_cache_mb"]) * 1024 * 1024,
+                            max_file_bytes=max_file_bytes, excerpt=excerpt)
+    except sqlite3.Error as e:
+        safe_update(status_callback, f"Content cache unavailable: {e}")
+        return None
+
+
+def close_content_cache(cache, status_callback):
+    if cache is None:
+        return
+    safe_update(status_callback, f"Content cache: {cache.hits} files reused, {cache.stores} stored.")
+    try:
+        cache.close()
+    except sqlite3.Error as e:
+        safe_update(status_callback, f"Could not update content cache: {e}")
+
+
+def timing_summary_path(output_file_path):
+    """ <output name>.timing.json, next to the output file (see output_sidecar_path). """
+    return output_sidecar_path(output_file_path, ".timing.json")
+
+
+def profile_paths(output_file_path):
+    """ <output name>.prof (cProfile dump) and <output name>.profile.txt (report), next to the output file. """
+    return output_sidecar_path(output_file_path, ".prof"), output_sidecar_path(output_file_path, ".profile.txt")
+
+def write_profile(profiler, output_file_path, root_path, mode, status_callback):
+    """
+    Saves the cProfile dump of the run and a text report of the slowest folders to
+    list, the slowest files to read (with their sizes) and the most expensive functions.
+    cProfile only sees the thread that called run_generation; folders and files handled
+    by worker threads show up in the slowest lists, which are recorded on every thread.
+    """
+    dump_path, report_path = profile_paths(output_file_path)
+    top = int(settings["profile_top"])
+    functions = io.StringIO()
+    pstats.Stats(profiler, stream=functions).sort_stats("cumulative").print_stats(top)
+    lines = [f"Profile of a {mode} run on {root_path}",
+             f"Started {metrics.started_at:%Y-%m-%d %H:%M:%S}, took {time.perf_counter() - metrics.started:,.1f} s",
+             "",
+             f"Slowest folders to list (of {metrics.values['dirs']:,} folders; listings reused from the scan index are not timed):"]
+    lines += [f"  {seconds * 1000:10,.1f} ms  {count:10,} entries  {path}" for seconds, path, count in metrics.slow_dirs.slowest()]
+    lines += ["", f"Slowest files to read (of {metrics.values['content_files']:,} files; cached blocks are not timed):"]
+    lines += [f"  {seconds * 1000:10,.1f} ms  {count:16,} bytes  {path}" for seconds, path, count in metrics.slow_files.slowest()]
+    lines += ["", f"Functions by cumulative time (open {dump_path.name} with pstats or snakeviz for the full profile):",
+              functions.getvalue()]
+    try:
+        profiler.dump_stats(str(dump_path))
+        with open(report_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines))
+        safe_update(status_callback, f"Profile written to: {report_path}")
+    except OSError as e:
+        safe_update(status_callback, f"Could not write profile: {e}")
+
+
+def finish_run(output_file_path, root_path, mode, interrupted, status_callback, profiler=None):
+    """
+    Reports the run's totals and writes the timing summary (see RunMetrics) next to the output,
+    plus the profile report when the run was profiled.
+    """
+    if profiler is not None:
+        profiler.disable()
+        write_profile(profiler, output_file_path, root_path, mode, status_callback)
+    try:
+        if not metrics.values["bytes_written"]: # A ShardedOutput adds up its parts itself
+            metrics.values["bytes_written"] = output_file_path.stat().st_size
+    except OSError:
+        pass
+    summary = metrics.summary()
+    counters = summary["counters"]
+    safe_update(status_callback, f"Finished in {summary['total_seconds']:,.1f} s: "
+                                 f"{counters['dirs']:,} folders, {counters['content_files']:,} files written, "
+                                 f"{counters['bytes_read'] / (1024 * 1024):,.1f} MB read, {counters['errors']} errors.")
+    if not settings["timing_summary"]:
+        return
+    summary.update({"root": str(root_path), "mode": mode, "output": str(output_file_path),
+                    "interrupted": interrupted, "settings": settings})
+    try:
+        with open(timing_summary_path(output_file_path), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+    except OSError as e:
+        safe_update(status_callback, f"Could not write timing summary: {e}")
+
+
+def atomic_temp_path(output_file_path):
+    """ Where an atomically replaced output is written first: .<output name>.tmp in the same folder. """
+    return output_file_path.with_name("." + output_file_path.name + ".tmp")
+
+def run_generation(root_path, mode, rules, status_callback, output_file_path=None, atomic=False, blocks=None):
+    """
+    Scans root_path and writes the snapshot file; returns its path.
+    Without output_file_path a new file is created in the outputs folder.
+    With atomic, the file is written next to the output and then renamed over it,
+    so readers see either the previous or the new snapshot, never a partial one.
+    blocks, if given, is filled with {file_rel_path: (start, end)} byte offsets of the
+    file blocks in the output (see TrackedOutput; not for sharded outputs). With the
+    block_index setting they are also saved next to the output (see BlockIndex).
+    Raises InterruptedError when stopped, KeyboardInterrupt on Ctrl+C (a partially written
+    file is marked as incomplete either way, or, with atomic, dropped).
+    """
+    global stop_requested, metrics
+    metrics = RunMetrics()
+    output_file_path = Path(output_file_path) if output_file_path else None
+    fmt = output_format()
+    compression = output_compression()
+    suffix = OUTPUT_COMPRESSION[compression][0] if compression else ""
+    shard_bytes = int(settings["shard_mb"]) * 1024 * 1024
+    shard_lines = int(settings["shard_lines"])
+    if (shard_bytes or shard_lines) and (atomic or blocks is not None):
+        raise ValueError("Sharded outputs cannot be replaced atomically or tracked block by block.")
+    index_blocks = bool(settings["block_index"])
+    if index_blocks and (shard_bytes or shard_lines):
+        safe_update(status_callback, "Block index skipped: the parts of a sharded output are listed in its manifest.")
+        index_blocks = False
+    if index_blocks and blocks is None:
+        blocks = {}
+    hierarchy = None # (start, end) of the hierarchy section, when blocks are tracked
+    sharded = None # The ShardedOutput, when the output is split into parts
+    write_path = None # Where the output is being written (a temporary file with atomic)
+    profiler = None
+    if settings["profile_run"]:
+        metrics.enable_hotspots(int(settings["profile_top"]))
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e: # Another profiler (e.g. a debugger) is active
+            safe_update(status_callback, f"Profiling disabled: {e}")
+            profiler = None
+    try:
+        # --- Scan Tree Structure and Content Files (single pass) ---
+        if mode == "Target":
+            safe_update(status_callback, "Scanning target tree structure...")
+        else:
+            safe_update(status_callback, "Scanning tree structure...")
+
+        # Streaming writes the hierarchy during the scan, so the output file is opened first
+        streaming = bool(settings["stream_hierarchy"]) and rules.streamable
+        collect_files = mode != "No Content" # file_paths is only collected for modes that include content
+        workers = int(settings["scan_workers"])
+        index = ScanIndex(root_path).load() if settings["scan_index"] else None
+        tree = file_paths = None
+        if not streaming:
+            with metrics.phase("scan"):
+                tree, file_paths = scan_tree(root_path, rules, status_callback, collect_files, workers, index)
+            if stop_requested: raise InterruptedError("Operation stopped by user.")
+            save_scan_index(index, status_callback)
+            if tree is None:
+                safe_update(status_callback, "Warning: Could not scan tree structure (check permissions?).")
+                tree = {} # Default to empty tree on error
+
+            # For "No Content" mode, file_paths remains None
+
+            # Handle cases where nothing was found
+            if not tree and not file_paths:
+                 safe_update(status_callback, "Warning: No matching files or folders found based on filters.")
+
+        # --- Generate Output File ---
+        if output_file_path is None:
+            output_dir = Path(get_outputs_folder_path())
+            output_dir.mkdir(exist_ok=True)
+            folder_name = root_path.name if root_path.name else "root"
+            first_part = FIRST_PART if shard_bytes or shard_lines else ""
+            output_file_path = unique_output_path(output_dir, folder_name, mode, status_callback,
+                                                  first_part + fmt.extension + suffix)
+        else:
+            output_file_path.parent.mkdir(parents=True, exist_ok=True)
+            if not output_file_path.name.endswith(suffix):
+                output_file_path = output_file_path.with_name(output_file_path.name + suffix)
+            if (shard_bytes or shard_lines) and FIRST_PART not in output_file_path.name:
+                plain = Path(output_file_path.name[:len(output_file_path.name) - len(suffix)]) # out.txt.gz -> out.txt
+                output_file_path = output_file_path.with_name(plain.stem + FIRST_PART + plain.suffix + suffix)
+
+        safe_update(status_callback, f"Writing output to: {output_file_path}")
+
+        write_path = atomic_temp_path(output_file_path) if atomic else output_file_path
+        if shard_bytes or shard_lines:
+            sharded = ShardedOutput(output_file_path, root_path, mode, compression, shard_bytes, shard_lines)
+            output = sharded
+        elif blocks is not None:
+            output = TrackedOutput(open_output(write_path, compression), blocks)
+        else:
+            output = open_output(write_path, compression)
+        with output as output_file:
+            if fmt.records:
+                output_file.write(fmt.snapshot_record(root_path, mode))
+            hierarchy_start = output_file.offset if blocks is not None else 0
+            if streaming:
+                safe_update(status_callback, "Writing hierarchy while scanning...")
+                if not fmt.records:
+                    output_file.write("Hierarchy of folders and files:\n\n")
+                    output_file.write(root_path.name + "\n")
+                with metrics.phase("scan"): # Includes writing the hierarchy
+                    line_count, file_paths = stream_tree(root_path, rules, output_file, status_callback,
+                                                         collect_files, workers, index,
+                                                         entry_record if fmt.records else None)
+                if stop_requested: raise InterruptedError("Operation stopped by user.")
+                save_scan_index(index, status_callback)
+                if not fmt.records:
+                    output_file.write("\n")
+                if not line_count and not file_paths:
+                    safe_update(status_callback, "Warning: No matching files or folders found based on filters.")
+            elif fmt.records:
+                with metrics.phase("hierarchy"):
+                    safe_update(status_callback, "Writing folder and file records...")
+                    write_tree_records(output_file, root_path, tree, file_paths)
+                if stop_requested: raise InterruptedError("Operation stopped by user.")
+            else:
+                # Option 2: show root folder name first
+                with metrics.phase("hierarchy"):
+                    tree_lines = [root_path.name]
+                    tree_lines += print_tree(tree)
+                    write_hierarchy(output_file, tree_lines, status_callback)
+                if stop_requested: raise InterruptedError("Operation stopped by user.")
+            if blocks is not None:
+                hierarchy = (hierarchy_start, output_file.offset)
+
+            # --- Write Content Section (Only if mode is NOT "No Content") ---
+            if mode != "No Content":
+                max_file_bytes = int(settings["max_file_kb"]) * 1024
+                excerpt = None
+                if settings["excerpt_large_files"]:
+                    excerpt = (int(settings["excerpt_head_lines"]), int(settings["excerpt_tail_lines"]))
+                duplicates = None
+                if settings["dedupe_contents"] and file_paths:
+                    safe_update(status_callback, "Looking for files with identical content...")
+                    with metrics.phase("dedupe"):
+                        duplicates = find_duplicate_files(root_path, file_paths, int(settings["read_workers"]))
+                    if stop_requested: raise InterruptedError("Operation stopped by user.")
+                    metrics.values["duplicates"] = len(duplicates)
+                    safe_update(status_callback, f"Duplicates: {len(duplicates):,} files are copies of an earlier file.")
+                cache = None
+                if file_paths and not fmt.records:
+                    cache = open_content_cache(root_path, max_file_bytes, excerpt, status_callback)
+                try:
+                    with metrics.phase("contents"):
+                        write_ok = write_file_contents(output_file, root_path, file_paths or [], status_callback,
+                                                       read_workers=int(settings["read_workers"]),
+                                                       prefetch_files=int(settings["read_prefetch_files"]),
+                                                       buffer_bytes=int(settings["read_buffer_mb"]) * 1024 * 1024,
+                                                       cache=cache, max_file_bytes=max_file_bytes,
+                                                       max_output_bytes=int(settings["max_output_mb"]) * 1024 * 1024,
+                                                       excerpt=excerpt, duplicates=duplicates, fmt=fmt)
+                finally:
+                    close_content_cache(cache, status_callback)
+                if not write_ok:
+                     raise InterruptedError("Operation stopped by user.")
+            else:
+                # Optionally write a note that content was skipped
+                output_file.write(fmt.contents_skipped)
+                safe_update(status_callback, "Skipping file content writing ('No Content' mode).")
+            if fmt.records:
+                output_file.write(fmt.end_record())
+
+        if atomic:
+            os.replace(write_path, output_file_path)
+        if index_blocks:
+            save_block_index(output_file_path, hierarchy, blocks, compression, status_callback)
+        if sharded is not None:
+            safe_update(status_callback, f"Output split into {len(sharded.parts)} parts; "
+                                         f"manifest: {manifest_path(output_file_path).name}")
+        finish_run(output_file_path, root_path, mode, False, status_callback, profiler)
+        return output_file_path
+
+    except (InterruptedError, KeyboardInterrupt): # Ctrl+C in a command-line run, or a cancelled batch job
+        if not atomic and output_file_path is not None and output_file_path.exists():
+            try:
+                marked_path = sharded.path if sharded is not None else output_file_path # The last part
+                with open_output(marked_path, compression, 'a') as f:
+                    f.write(fmt.interrupted_note)
+                safe_update(status_callback, f"Marked incomplete file: {marked_path}")
+            except Exception as e_write:
+                safe_update(status_callback, f"Could not mark incomplete file: {e_write}")
+            finish_run(output_file_path, root_path, mode, True, status_callback, profiler)
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable() # Already done by finish_run unless the run failed
+        if atomic and write_path is not None:
+            with contextlib.suppress(OSError):
+                os.remove(write_path) # Left over only if the run failed
+
+# ======================================================================
+# Watch Mode (keeps an output up to date while the folder changes)
+# ======================================================================
+WATCH_DEBOUNCE_SECONDS = 0.3  # A burst of changes is over after this long without events
+WATCH_MAX_DELAY_SECONDS = 5.0 # ... or at the latest this long after its first event
+WATCH_POLL_SECONDS = 2.0      # Interval of PollingWatcher
+WATCH_WAKEUP_SECONDS = 0.5    # How often an idle watch checks stop_requested
+
+class FolderChanges:
+    """ Changes collected by a watcher: modified files, created/deleted/renamed entries, or 'rescan'. """
+    def __init__(self):
+        self.modified = set() # Paths of files whose content may have changed
+        self.entries = set()  # Paths created, deleted or renamed
+        self.rescan = False   # Events were lost, or a folder changed in an unknown way
+
+
+class InotifyWatcher:
+    """
+    Change notifications of the Linux kernel (inotify, called through ctypes, so no
+    extra package is needed), one watch per folder. Raises OSError where inotify is
+    not available or the watch limit (fs.inotify.max_user_watches) is reached, so the
+    caller can fall back to a PollingWatcher.
+    """
+    IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+    IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+    IN_DELETE_SELF, IN_MOVE_SELF = 0x400, 0x800
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+    CONTENT_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE
+    ENTRY_EVENTS = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, len; then len bytes of NUL-padded name
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise_errno()
+        self.folders = {} # Watch descriptor -> folder path
+        self.watched = set()
+
+    def _raise_errno(self):
+        error = self.ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+    def watch(self, folders, files=()):
+        """ Watches the folders not watched yet (a folder's watch also reports its files). """
+        for folder in folders:
+            if folder in self.watched:
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), self.CONTENT_EVENTS | self.ENTRY_EVENTS)
+            if wd < 0:
+                if self.ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                    continue # Gone or unreadable since the scan
+                self._raise_errno()
+            self.folders[wd] = folder
+            self.watched.add(folder)
+
+    def read(self, timeout, changes):
+        """ Waits up to timeout seconds for events and adds them to changes; returns True if there were any. """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return False
+        position = 0
+        while position + self.EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, position)
+            position += self.EVENT_HEADER.size
+            name = os.fsdecode(data[position:position + length].rstrip(b"\0"))
+            position += length
+            if mask & self.IN_Q_OVERFLOW:
+                changes.rescan = True
+            elif mask & self.IN_IGNORED: # The folder was deleted or moved away
+                self.watched.discard(self.folders.pop(wd, None))
+            elif wd in self.folders:
+                path = os.path.join(self.folders[wd], name) if name else self.folders[wd]
+                if mask & self.ENTRY_EVENTS:
+                    changes.entries.add(path)
+                elif not mask & self.IN_ISDIR:
+                    changes.modified.add(path)
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Fallback of InotifyWatcher (other systems, network mounts, too many folders):
+    every poll_seconds, stats the watched folders and files and reports the differences.
+    A changed folder only tells that entries were added or removed, so it asks for a rescan.
+    """
+    def __init__(self, poll_seconds=WATCH_POLL_SECONDS):
+        self.poll_seconds = poll_seconds
+        self.folders = {}
+        self.files = {}
+        self.next_poll = time.monotonic() + poll_seconds
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+            return st.st_mtime_ns, st.st_size, st.st_ino
+        except OSError:
+            return None
+
+    def watch(self, folders, files=()):
+        """ Replaces the watched folders and files, taking their current state as the reference. """
+        self.folders = {folder: self._stat(folder) for folder in folders}
+        self.files = {path: self._stat(path) for path in files}
+
+    def read(self, timeout, changes):
+        wait = self.next_poll - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return False
+        time.sleep(max(wait, 0))
+        self.next_poll = time.monotonic() + self.poll_seconds
+        found = False
+        for snapshot, is_folder in ((self.folders, True), (self.files, False)):
+            for path, old in snapshot.items():
+                new = self._stat(path)
+                if new != old:
+                    snapshot[path] = new
+                    found = True
+                    if is_folder:
+                        changes.rescan = True
+                    else:
+                        changes.modified.add(path)
+        return found
+
+    def close(self):
+        pass
+
+
+def copy_bytes(source, target, nbytes):
+    """ Copies nbytes from the binary file source to target. """
+    while nbytes > 0:
+        data = source.read(min(nbytes, 1024 * 1024))
+        if not data:
+            break
+        target.write(data)
+        nbytes -= len(data)
+
+
+class SnapshotWatcher:
+    """
+    Watch mode: keeps the output of one folder and mode up to date. After a full run
+    it waits for changes (InotifyWatcher, or a PollingWatcher where inotify is not
+    available or poll_seconds is given) and lets a burst of events settle, then:
+      - when only the content of files in the output changed, their blocks are read
+        again and spliced into the output, the rest of which is copied byte for byte;
+      - otherwise the output is generated again, with the scan index and the content
+        cache, so only changed folders are listed and only changed files are read.
+    The output file is replaced atomically either way (see run_generation).
+    start() writes the first output, watch() then runs until stop_requested is set.
+    """
+    def __init__(self, root_path, mode, rules, status_callback, output_file_path=None,
+                 debounce=WATCH_DEBOUNCE_SECONDS, poll_seconds=None):
+        self.root_path = root_path
+        self.mode = mode
+        self.rules = rules
+        self.status_callback = status_callback
+        self.output_file_path = Path(output_file_path) if output_file_path else None
+        self.debounce = debounce
+        self.poll_seconds = poll_seconds
+        self.blocks = {}
+        self.listed = {}
+        # Splicing needs plain text whose blocks do not depend on each other
+        self.can_splice = (mode != "No Content" and output_compression() is None and not settings["dedupe_contents"]
+                           and not int(settings["max_output_mb"]) and not output_format().records)
+        self.own_prefixes = (get_scan_index_folder_path(), get_content_cache_path())
+
+    def _open_watcher(self):
+        if self.poll_seconds is None:
+            try:
+                return InotifyWatcher()
+            except OSError as e:
+                safe_update(self.status_callback, f"Change notifications unavailable ({e}); polling every {WATCH_POLL_SECONDS:g} s.")
+        return PollingWatcher(self.poll_seconds or WATCH_POLL_SECONDS)
+
+    def _watch_tree(self):
+        root = os.fspath(self.root_path)
+        folders = [os.path.join(root, key) if key else root for key in self.listed]
+        files = [os.path.join(root, file_rel_path) for file_rel_path in self.blocks]
+        try:
+            self.watcher.watch(folders, files)
+        except OSError as e: # Typically the inotify watch limit
+            safe_update(self.status_callback, f"Change notifications failed ({e}); polling every {WATCH_POLL_SECONDS:g} s.")
+            self.watcher.close()
+            self.watcher = PollingWatcher(self.poll_seconds or WATCH_POLL_SECONDS)
+            self.watcher.watch(folders, files)
+
+    def regenerate(self):
+        blocks = {} if self.can_splice else None
+        self.output_file_path = run_generation(self.root_path, self.mode, self.rules, self.status_callback,
+                                               self.output_file_path, atomic=True, blocks=blocks)
+        self.blocks = blocks or {}
+        # Folders reached by the scan, with the names they held (see ScanIndex)
+        self.listed = {key: set(record[2]) for key, record in ScanIndex(self.root_path).load().old.items()}
+
+    def _is_own_file(self, path):
+        """ True for the files written by the run itself (output, temporary file, reports, index, cache). """
+        if path.startswith(self.own_prefixes):
+            return True
+        folder, name = os.path.split(path)
+        output = self.output_file_path
+        stem = output_stem(output) # Also matches the temporary files (see atomic_temp_path)
+        return folder == os.fspath(output.parent) and name.startswith((stem, "." + stem))
+
+    def _was_listed(self, path):
+        folder, name = os.path.split(os.path.relpath(path, self.root_path))
+        return name in self.listed.get(folder, ())
+
+    def _changed_blocks(self, changes):
+        """ The rel paths of files whose block has to be rewritten, or None if the tree changed. """
+        if changes.rescan:
+            return None
+        for path in changes.entries:
+            if self._is_own_file(path):
+                continue
+            existed = self._was_listed(path)
+            if existed != os.path.lexists(path):
+                return None # Created or deleted: the hierarchy changed
+            if existed:
+                changes.modified.add(path) # Replaced, e.g. by an editor saving through a rename
+        changed = set()
+        for path in changes.modified:
+            if not self._is_own_file(path):
+                file_rel_path = os.path.relpath(path, self.root_path).replace(os.sep, '/')
+                if file_rel_path in self.blocks:
+                    changed.add(file_rel_path)
+        return changed
+
+    def splice(self, changed):
+        """ Rewrites the blocks of the changed files, copying the rest of the previous output. """
+        max_file_bytes = int(settings["max_file_kb"]) * 1024
+        excerpt = None
+        if settings["excerpt_large_files"]:
+            excerpt = (int(settings["excerpt_head_lines"]), int(settings["excerpt_tail_lines"]))
+        order = sorted(changed, key=lambda file_rel_path: self.blocks[file_rel_path][0])
+        temp_path = atomic_temp_path(self.output_file_path)
+        new_blocks = {}
+        try:
+            with open(self.output_file_path, 'rb') as old, open(temp_path, 'wb') as new:
+                text = io.TextIOWrapper(new, encoding='utf-8')
+                for file_rel_path in order:
+                    start, end = self.blocks[file_rel_path]
+                    copy_bytes(old, new, start - old.tell())
+                    block = read_content_block(self.root_path, file_rel_path, None, None, max_file_bytes, excerpt)
+                    new_start = new.tell()
+                    if isinstance(block, StreamedBlock):
+                        block.write_to(text)
+                    else:
+                        text.write(block)
+                    text.flush()
+                    new_blocks[file_rel_path] = (new_start, new.tell())
+                    old.seek(end)
+                copy_bytes(old, new, float('inf'))
+                text.detach() # new is closed by the with statement
+            os.replace(temp_path, self.output_file_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+            raise
+
+        # Blocks after a rewritten one move by the size difference up to that point
+        shifts = [(self.blocks[rel][1], new_blocks[rel][1] - self.blocks[rel][1]) for rel in order]
+        ends = [end for end, _ in shifts]
+        for file_rel_path, (start, end) in self.blocks.items():
+            if file_rel_path in new_blocks:
+                continue
+            i = bisect.bisect_right(ends, start)
+            if i:
+                delta = shifts[i - 1][1]
+                self.blocks[file_rel_path] = (start + delta, end + delta)
+        self.blocks.update(new_blocks)
+        if settings["block_index"]: # The hierarchy before the blocks did not move
+            try:
+                index = BlockIndex.load(self.output_file_path, verify=False)
+            except (OSError, ValueError) as e:
+                safe_update(self.status_callback, f"Could not update block index: {e}")
+            else:
+                save_block_index(self.output_file_path, index.hierarchy, self.blocks, None, self.status_callback)
+
+    def _wait_for_changes(self):
+        """ Returns the changes of the next burst of events, or None once stop_requested is set. """
+        changes = FolderChanges()
+        while not self.watcher.read(WATCH_WAKEUP_SECONDS, changes):
+            if stop_requested:
+                return None
+        first = time.monotonic()
+        while time.monotonic() - first < WATCH_MAX_DELAY_SECONDS and self.watcher.read(self.debounce, changes):
+            pass
+        return changes
+
+    def start(self):
+        """ Writes the output a first time and starts watching; returns the output path. """
+        self.regenerate()
+        self.watcher = self._open_watcher()
+        self._watch_tree()
+        safe_update(self.status_callback, f"Watching {self.root_path} (output: {self.output_file_path})")
+        return self.output_file_path
+
+    def watch(self):
+        """ Updates the output after every burst of changes until stop_requested is set. """
+        try:
+            while not stop_requested:
+                changes = self._wait_for_changes()
+                if changes is None:
+                    break
+                changed = self._changed_blocks(changes)
+                started = time.perf_counter()
+                if changed is None:
+                    self.regenerate()
+                    what = "regenerated"
+                elif changed:
+                    try:
+                        self.splice(changed)
+                        what = f"{len(changed)} changed file{'s' if len(changed) > 1 else ''} rewritten"
+                    except OSError as e: # E.g. the output was removed
+                        safe_update(self.status_callback, f"Could not update the output in place ({e}).")
+                        self.regenerate()
+                        what = "regenerated"
+                else:
+                    continue # Only files that are not in the output changed
+                self._watch_tree()
+                safe_update(self.status_callback, f"Output updated in {(time.perf_counter() - started) * 1000:,.0f} ms ({what}).")
+        finally:
+            self.watcher.close()
+        return self.output_file_path
+
+# ======================================================================
+# Command-Line Interface (headless: no GUI modules are imported)
+# ======================================================================
+CLI_MODES = {"classic": "Classic", "target": "Target", "no-content": "No Content"}
+
+def build_arg_parser():
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="file-tree-builder",
+        description="Snapshot a folder into a Markdown-style .txt (hierarchy, optionally followed by file contents). "
+                    "Run without arguments to open the GUI.",
+        epilog="'file-tree-builder extract OUTPUT PATH...' prints file blocks of an output written with --block-index; "
+               "'file-tree-builder batch JOBS.json' snapshots many folders on a pool of worker processes.")
+    parser.add_argument("folder", help="folder to snapshot")
+    parser.add_argument("-m", "--mode", choices=list(CLI_MODES), default="classic",
+                        help="scan mode (default: classic)")
+    parser.add_argument("--ignore", metavar="ITEMS",
+                        help="Ignore Items, pipe-separated (default: helpers/ignore_items.json)")
+    parser.add_argument("--ignore-exts", metavar="EXTS",
+                        help="Ignore Exts, pipe-separated (default: helpers/ignore_exts.json)")
+    parser.add_argument("--target", metavar="ITEMS", default="", help="Target Items, pipe-separated")
+    parser.add_argument("--target-exts", metavar="EXTS", default="", help="Target Exts, pipe-separated")
+    parser.add_argument("--gitignore", dest="use_gitignore", action="store_true", default=None,
+                        help="respect .gitignore files")
+    parser.add_argument("--no-gitignore", dest="use_gitignore", action="store_false")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="output file (default: a new file in the outputs folder)")
+    parser.add_argument("--scan-workers", type=int, metavar="N", help="threads listing folders")
+    parser.add_argument("--read-workers", type=int, metavar="N", help="threads reading file contents")
+    parser.add_argument("--max-file-kb", type=int, metavar="KB", help="KiB written of each file (0 = whole files)")
+    parser.add_argument("--max-output-mb", type=int, metavar="MB",
+                        help="MiB of file contents written in total (0 = no limit)")
+    parser.add_argument("--excerpt", dest="excerpt_large_files", action="store_true", default=None,
+                        help="show the first and last lines of files over --max-file-kb")
+    parser.add_argument("--no-excerpt", dest="excerpt_large_files", action="store_false")
+    parser.add_argument("--profile", dest="profile_run", action="store_true", default=None,
+                        help="write a profile report (slowest folders, files and functions) next to the output")
+    parser.add_argument("--shard-mb", type=int, metavar="MB",
+                        help="split the output into <name>_part001.txt, ... of about MB MiB each, with a manifest")
+    parser.add_argument("--shard-lines", type=int, metavar="N", help="also start a new part after N lines")
+    parser.add_argument("--dedupe", dest="dedupe_contents", action="store_true", default=None,
+                        help="write files identical to an earlier one as a reference to it")
+    parser.add_argument("--format", dest="output_format", choices=list(OUTPUT_FORMATS),
+                        help="output format: the Markdown-style text (default) or NDJSON records (.ndjson)")
+    parser.add_argument("--block-index", dest="block_index", action="store_true", default=None,
+                        help="write <output>.blocks.json with the offset of every file block (see 'extract')")
+    parser.add_argument("--compress", choices=["none"] + list(OUTPUT_COMPRESSION),
+                        help="compress the output file (.txt.gz, .txt.xz or .txt.bz2)")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and update the output whenever the folder changes (Ctrl+C to stop)")
+    parser.add_argument("--debounce-ms", type=int, metavar="MS", default=int(WATCH_DEBOUNCE_SECONDS * 1000),
+                        help="with --watch, quiet time after a change before updating (default: %(default)s)")
+    parser.add_argument("--poll", type=float, metavar="SECONDS",
+                        help="with --watch, check for changes by polling at this interval instead of "
+                             "change notifications (e.g. for network drives)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print the output path")
+    return parser
+
+def _print_status(message):
+    timestamp = datetime.datetime.now().strftime("%H:%M:%S")
+    print(f"[{timestamp}] {message}", file=sys.stderr)
+
+def run_extract(argv):
+    """ 'extract OUTPUT [PATH ...]': writes blocks of an output to stdout using its block index. """
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="file-tree-builder extract",
+        description="Print file blocks of an output written with --block-index, each read with one seek.")
+    parser.add_argument("output", help="output file (its <output>.blocks.json must be next to it)")
+    parser.add_argument("paths", nargs="*", metavar="PATH", help="files to print, by their path in the output")
+    parser.add_argument("--hierarchy", action="store_true", help="print the hierarchy section first")
+    parser.add_argument("--list", action="store_true", help="only list the paths in the index")
+    args = parser.parse_args(argv)
+    try:
+        index = BlockIndex.load(args.output)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    out = sys.stdout.buffer
+    if args.list:
+        for file_rel_path in index.blocks:
+            out.write((file_rel_path + "\n").encode('utf-8'))
+        return 0
+    missing = 0
+    wanted = ([None] if args.hierarchy else []) + [path.replace(os.sep, '/') for path in args.paths]
+    for file_rel_path in wanted:
+        try:
+            out.write(index.read(file_rel_path))
+        except KeyError:
+            print(f"Not in the index: {file_rel_path or 'hierarchy'}", file=sys.stderr)
+            missing += 1
+        except (OSError, EOFError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 1
+    out.flush()
+    return 1 if missing else 0
+
+def run_cli(argv):
+    """ Runs one generation from command-line arguments; returns the process exit code. """
+    global headless, stop_requested, last_output_path
+    if argv and argv[0] == "extract": # A folder named 'extract' or 'batch' can be given as ./extract
+        return run_extract(argv[1:])
+    if argv and argv[0] == "batch":
+        return run_batch(argv[1:])
+    args = build_arg_parser().parse_args(argv)
+    headless = True # status callbacks run directly, there is no Tk loop
+    stop_requested = False
+    status_callback = (lambda message: None) if args.quiet else _print_status
+
+    root_path = Path(args.folder).resolve()
+    if not root_path.is_dir():
+        print(f"Error: The path '{root_path}' is not a valid directory.", file=sys.stderr)
+        return 2
+
+    if args.scan_workers is not None:
+        settings["scan_workers"] = args.scan_workers
+    if args.read_workers is not None:
+        settings["read_workers"] = args.read_workers
+    if args.max_file_kb is not None:
+        settings["max_file_kb"] = args.max_file_kb
+    if args.max_output_mb is not None:
+        settings["max_output_mb"] = args.max_output_mb
+    if args.excerpt_large_files is not None:
+        settings["excerpt_large_files"] = args.excerpt_large_files
+    if args.profile_run is not None:
+        settings["profile_run"] = args.profile_run
+    if args.output_format is not None:
+        settings["output_format"] = args.output_format
+    if args.block_index is not None:
+        settings["block_index"] = args.block_index
+    if args.compress is not None:
+        settings["output_compression"] = args.compress
+    if args.dedupe_contents is not None:
+        settings["dedupe_contents"] = args.dedupe_contents
+    if args.shard_mb is not None:
+        settings["shard_mb"] = args.shard_mb
+    if args.shard_lines is not None:
+        settings["shard_lines"] = args.shard_lines
+    use_gitignore = settings["use_gitignore"] if args.use_gitignore is None else args.use_gitignore
+    ignore_items = "|".join(ignore_items_list) if args.ignore is None else args.ignore
+    ignore_exts = "|".join(ignore_exts_list) if args.ignore_exts is None else args.ignore_exts
+
+    mode = CLI_MODES[args.mode]
+    try:
+        rules = build_rules(mode, root_path, ignore_items, ignore_exts, args.target, args.target_exts,
+                            use_gitignore, status_callback)
+        status_callback(f"Starting generation for '{root_path.name}' in {mode} mode...")
+        if args.watch:
+            return run_watch(root_path, mode, rules, status_callback, args)
+        last_output_path = run_generation(root_path, mode, rules, status_callback, args.output)
+    except (InterruptedError, KeyboardInterrupt):
+        stop_requested = True
+        print("Operation stopped.", file=sys.stderr)
+        return 130
+    except Exception as e:
+        print(f"Error: An error occurred during generation: {e}", file=sys.stderr)
+        return 1
+
+    status_callback("Generation complete.")
+    print(last_output_path)
+    return 0
+
+def run_watch(root_path, mode, rules, status_callback, args):
+    """ --watch: keeps the output up to date until Ctrl+C; the output path is printed after the first run. """
+    global last_output_path
+    # Regenerating relies on both to only list changed folders and read changed files
+    settings["scan_index"] = True
+    settings["content_cache"] = True
+
+    watcher = SnapshotWatcher(root_path, mode, rules, status_callback, args.output,
+                              max(args.debounce_ms, 0) / 1000, args.poll)
+    last_output_path = watcher.start()
+    print(last_output_path, flush=True)
+    try:
+        watcher.watch()
+    except KeyboardInterrupt:
+        pass
+    status_callback("Watch stopped.")
+    return 0
+
+# ======================================================================
+# Batch Mode (many root folders on a pool of worker processes)
+# ======================================================================
+BATCH_PROGRESS_SECONDS = 5.0       # Interval of the report on the running jobs
+BATCH_TICK_SECONDS = 0.2           # How often the batch checks for finished jobs
+BATCH_CANCEL_GRACE_SECONDS = 10.0  # A cancelled job still running after this long is killed
+# Job fields passed on as the command-line option of the same meaning
+BATCH_JOB_OPTIONS = {"mode": "--mode", "ignore": "--ignore", "ignore_exts": "--ignore-exts",
+                     "target": "--target", "target_exts": "--target-exts", "output": "--output"}
+BATCH_JOB_FIELDS = {"name", "folder", "gitignore", "args", "timeout"} | set(BATCH_JOB_OPTIONS)
+# Jobs run in their own process group: Ctrl+C reaches only the batch, which interrupts each job once
+if os.name == "nt":
+    BATCH_POPEN_ARGS = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+else:
+    BATCH_POPEN_ARGS = {"start_new_session": True}
+
+def self_command():
+    """ The command that starts this program: the frozen executable, or this script with the running Python. """
+    if getattr(sys, 'frozen', False):
+        return [sys.executable]
+    return [sys.executable, os.path.abspath(__file__)]
+
+
+class BatchJob:
+    """
+    One root folder of a batch, run as a headless generation (see run_cli) with the
+    mode, filters, output and extra arguments of its entry in the batch file; and
+    its state while the batch runs. Relative paths are taken from base_dir.
+    """
+    def __init__(self, number, spec, base_dir="."):
+        unknown = set(spec) - BATCH_JOB_FIELDS
+        if unknown:
+            raise ValueError(f"Job {number}: unknown field(s) {', '.join(sorted(unknown))}.")
+        if not spec.get("folder"):
+            raise ValueError(f"Job {number}: 'folder' is required.")
+        mode = str(spec.get("mode", "classic"))
+        if mode not in CLI_MODES:
+            raise ValueError(f"Job {number}: unknown mode '{mode}' (use {', '.join(CLI_MODES)}).")
+        self.number = number
+        self.folder = os.path.normpath(os.path.join(base_dir, os.path.expanduser(str(spec["folder"]))))
+        self.name = str(spec.get("name") or os.path.basename(self.folder) or self.folder)
+        self.mode = CLI_MODES[mode]
+        self.timeout = float(spec["timeout"]) if spec.get("timeout") else None
+        self.args = [self.folder]
+        for key, option in BATCH_JOB_OPTIONS.items():
+            value = spec.get(key)
+            if value is None:
+                continue
+            if isinstance(value, list): # Filters may be given as lists instead of pipe-separated
+                value = "|".join(str(item) for item in value)
+            elif key == "output":
+                value = os.path.join(base_dir, os.path.expanduser(str(value)))
+            self.args += [option, str(value)]
+        if "gitignore" in spec:
+            self.args.append("--gitignore" if spec["gitignore"] else "--no-gitignore")
+        extra = [str(arg) for arg in spec.get("args", [])]
+        if "--watch" in extra:
+            raise ValueError(f"Job {number}: --watch never finishes, so it cannot be part of a batch.")
+        self.args += extra
+        # Jobs that would write the same output file must not run at the same time
+        if spec.get("output"):
+            self.output_key = os.path.normcase(os.path.abspath(self.args[self.args.index("--output") + 1]))
+        else:
+            self.output_key = (os.path.basename(self.folder), self.mode) # See unique_output_path
+
+        self.state = "pending" # 'running', then 'done', 'failed' or 'cancelled'
+        self.status = ""       # Latest progress message
+        self.messages = deque(maxlen=5) # Last messages, for the error of a failed job
+        self.output = None
+        self.returncode = None
+        self.started = None
+        self.finished = None
+        self.process = None
+        self.cancel_requested = False
+        self.timed_out = False
+
+    @property
+    def seconds(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.monotonic()) - self.started
+
+    def summary(self):
+        """ The job's entry in the batch summary. """
+        return {"name": self.name, "folder": self.folder, "mode": self.mode, "state": self.state,
+                "exit_code": self.returncode,
+                "seconds": round(self.seconds, 3) if self.seconds is not None else None,
+                "output": self.output,
+                "error": self.messages[-1] if self.state == "failed" and self.messages else None}
+
+
+def load_batch_jobs(batch_file_path):
+    """
+    Reads a batch file: a JSON list of jobs, or {"defaults": {...}, "jobs": [...]}, the
+    defaults applying to every job. A job is an object (see BatchJob) or just a folder path.
+    Raises OSError or ValueError.
+    """
+    with open(batch_file_path, encoding='utf-8') as f:
+        data = json.load(f)
+    defaults = {}
+    if isinstance(data, dict):
+        defaults = data.get("defaults") or {}
+        data = data.get("jobs")
+    if not isinstance(data, list) or not data or not isinstance(defaults, dict):
+        raise ValueError("The batch file holds no jobs (expected a list, or an object with 'jobs').")
+    base_dir = os.path.dirname(os.path.abspath(batch_file_path))
+    jobs = []
+    for number, spec in enumerate(data, 1):
+        if isinstance(spec, str):
+            spec = {"folder": spec}
+        if not isinstance(spec, dict):
+            raise ValueError(f"Job {number}: expected an object or a folder path.")
+        jobs.append(BatchJob(number, {**defaults, **spec}, base_dir))
+    return jobs
+
+
+class BatchRunner:
+    """
+    Runs BatchJobs on at most `workers` worker processes, each a headless run of this
+    program. Jobs share no state (stop flag, run metrics, settings), so they run side by
+    side, and reading and decoding spread over the CPU cores. Jobs that would write the
+    same output run one after the other, in batch order.
+    status_callback gets the start and end of each job and, every BATCH_PROGRESS_SECONDS,
+    the latest progress of the running ones. cancel(job) stops one job, cancel_all() the
+    batch; a running job is interrupted like Ctrl+C, so its output is marked as incomplete.
+    """
+    def __init__(self, jobs, workers=1, status_callback=None):
+        self.jobs = jobs
+        self.workers = max(1, workers)
+        self.status_callback = status_callback
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.started_at = None
+        self.seconds = 0.0
+
+    def run(self):
+        """ Runs all jobs and returns the summary (see summary()); Ctrl+C cancels the batch. """
+        chains = {}
+        for job in self.jobs:
+            chains.setdefault(job.output_key, []).append(job)
+        self.started_at = datetime.datetime.now()
+        started = time.monotonic()
+        safe_update(self.status_callback, f"Batch: {len(self.jobs)} jobs on {self.workers} workers.")
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="batch")
+        try:
+            futures = [executor.submit(self._run_chain, chain) for chain in chains.values()]
+            next_report = time.monotonic() + BATCH_PROGRESS_SECONDS
+            while not all(future.done() for future in futures):
+                try:
+                    time.sleep(BATCH_TICK_SECONDS)
+                    if time.monotonic() >= next_report:
+                        self._report_progress()
+                        next_report += BATCH_PROGRESS_SECONDS
+                except KeyboardInterrupt:
+                    safe_update(self.status_callback, "Batch: cancelling...")
+                    self.cancel_all()
+            for future in futures:
+                future.result() # Re-raises an unexpected error of a worker thread
+        finally:
+            executor.shutdown(wait=True)
+        self.seconds = time.monotonic() - started
+        return self.summary()
+
+    def _run_chain(self, chain):
+        for job in chain:
+            self._run_job(job)
+
+    def _run_job(self, job):
+        with self.lock:
+            if self.cancelled or job.cancel_requested:
+                job.state = "cancelled"
+                return
+            job.state = "running"
+            job.started = time.monotonic()
+            try:
+                job.process = subprocess.Popen(self_command() + job.args, stdin=subprocess.DEVNULL,
+                                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                               encoding='utf-8', errors='replace',
+                                               env=dict(os.environ, PYTHONIOENCODING='utf-8'), **BATCH_POPEN_ARGS)
+            except OSError as e:
+                job.finished = time.monotonic()
+                job.state = "failed"
+                job.messages.append(f"Could not start: {e}")
+                return
+        safe_update(self.status_callback, f"[{job.name}] started (job {job.number} of {len(self.jobs)}).")
+        timer = None
+        if job.timeout:
+            timer = threading.Timer(job.timeout, self._time_out, (job,))
+            timer.daemon = True
+            timer.start()
+
+        output_lines = []
+        reader = threading.Thread(target=lambda: output_lines.extend(job.process.stdout), daemon=True)
+        reader.start()
+        for line in job.process.stderr: # Status lines of the run, see _print_status
+            message = re.sub(r"^\[\d\d:\d\d:\d\d\] ", "", line.rstrip("\n"))
+            if message:
+                job.status = message
+                job.messages.append(message)
+        reader.join()
+        job.returncode = job.process.wait()
+        job.finished = time.monotonic()
+        if timer is not None:
+            timer.cancel()
+
+        if job.returncode == 0:
+            job.state = "done"
+            job.output = output_lines[-1].strip() if output_lines else None
+            safe_update(self.status_callback, f"[{job.name}] done in {job.seconds:,.1f} s: {job.output}")
+        elif job.cancel_requested and not job.timed_out:
+            job.state = "cancelled"
+            safe_update(self.status_callback, f"[{job.name}] cancelled after {job.seconds:,.1f} s.")
+        else:
+            job.state = "failed"
+            if job.timed_out:
+                job.messages.append(f"Timed out after {job.timeout:g} s.")
+            safe_update(self.status_callback, f"[{job.name}] failed (exit code {job.returncode}): "
+                                              f"{job.messages[-1] if job.messages else 'no message'}")
+
+    def _time_out(self, job):
+        job.timed_out = True
+        self.cancel(job)
+
+    def cancel(self, job):
+        """ Cancels one job: a pending job never starts, a running one is interrupted. """
+        with self.lock:
+            job.cancel_requested = True
+            process = job.process if job.state == "running" else None
+        if process is None or process.poll() is not None:
+            return
+        try:
+            if os.name == "nt":
+                process.terminate()
+            else:
+                process.send_signal(signal.SIGINT) # Stops the run like Ctrl+C
+        except OSError:
+            return # Already gone
+        killer = threading.Timer(BATCH_CANCEL_GRACE_SECONDS, lambda: process.poll() is None and process.kill())
+        killer.daemon = True
+        killer.start()
+
+    def cancel_all(self):
+        """ Cancels the jobs not started yet and interrupts the running ones. """
+        with self.lock:
+            self.cancelled = True
+        for job in self.jobs:
+            if job.state in ("pending", "running"):
+                self.cancel(job)
+
+    def _report_progress(self):
+        running = [job for job in self.jobs if job.state == "running"]
+        finished = sum(job.state in ("done", "failed", "cancelled") for job in self.jobs)
+        safe_update(self.status_callback, f"Batch: {finished} of {len(self.jobs)} jobs finished, {len(running)} running.")
+        for job in running:
+            safe_update(self.status_callback, f"  [{job.name}] {job.seconds:,.0f} s: {job.status}")
+
+    def summary(self):
+        """ Start time, total duration and, per job, its state, duration and output path (or error). """
+        counts = {state: sum(job.state == state for job in self.jobs) for state in ("done", "failed", "cancelled")}
+        return {"started": self.started_at.isoformat(timespec='seconds') if self.started_at else None,
+                "seconds": round(self.seconds, 3), "workers": self.workers, **counts,
+                "jobs": [job.summary() for job in self.jobs]}
+
+
+def run_batch(argv):
+    """ 'batch JOBS.json': snapshots every folder of a batch file; returns the process exit code. """
+    global headless
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="file-tree-builder batch",
+        description="Snapshot many folders, each with its own mode and filters, on a pool of worker processes.")
+    parser.add_argument("jobs", help="batch file: a JSON list of jobs, or {\"defaults\": {...}, \"jobs\": [...]}")
+    parser.add_argument("-j", "--workers", type=int, metavar="N",
+                        help="jobs run at the same time (default: the number of CPU cores)")
+    parser.add_argument("--summary", metavar="FILE",
+                        help="where to write the JSON summary (default: batch_<date>_<time>.json in the outputs folder)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print the output paths")
+    args = parser.parse_args(argv)
+    headless = True # status callbacks run directly, there is no Tk loop
+    status_callback = (lambda message: None) if args.quiet else _print_status
+    try:
+        jobs = load_batch_jobs(args.jobs)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+
+    runner = BatchRunner(jobs, args.workers or os.cpu_count() or 1, status_callback)
+    summary = runner.run()
+    if args.summary:
+        summary_path = Path(args.summary)
+    else:
+        summary_path = Path(get_outputs_folder_path()) / f"batch_{runner.started_at:%Y%m%d_%H%M%S}.json"
+    try:
+        summary_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+    except OSError as e:
+        print(f"Error: Could not write batch summary: {e}", file=sys.stderr)
+
+    status_callback(f"Batch finished in {summary['seconds']:,.1f} s: {summary['done']} done, "
+                    f"{summary['failed']} failed, {summary['cancelled']} cancelled. Summary: {summary_path}")
+    if not args.quiet:
+        for job in jobs:
+            seconds = f"{job.seconds:9,.1f} s" if job.seconds is not None else " " * 11
+            print(f"  {job.state:<9} {seconds}  {job.name}: {job.output or (job.messages[-1] if job.messages else '')}",
+                  file=sys.stderr)
+    for job in jobs:
+        if job.output:
+            print(job.output)
+    if runner.cancelled:
+        return 130
+    return 0 if summary["done"] == len(jobs) else 1
+
+# ======================================================================
+# GUI Toolkit Imports
+# ======================================================================
+# The window is only built when the script is started without arguments.
+# Command-line runs and imports of this file (e.g. benchmarks) never load Tk,
+# CustomTkinter or the Windows helpers, so they start in milliseconds.
+GUI_ENABLED = __name__ == "__main__" and len(sys.argv) <= 1
+
+if GUI_ENABLED:
+    import tkinter as tk
+    from tkinter import filedialog, messagebox
+    import customtkinter as ctk
+    import ctypes
+    from ctypes import wintypes
+
+    # Drag & drop support (using windnd for Windows focus, similar to example)
+    try:
+        import windnd
+        HAS_WINDND = True
+    except ImportError:
+        HAS_WINDND = False
+        print("Optional dependency 'windnd' not found. Drag and drop will not work on Windows.")
+        print("Install using: pip install windnd")
+
+    # DPI Awareness (from example)
+    try:
+        # Try modern DPI awareness setting (Windows 8.1+)
+        ctypes.windll.shcore.SetProcessDpiAwareness(1) # PROCESS_PER_MONITOR_DPI_AWARE
+    except AttributeError:
+        try:
+            # Fallback for older Windows versions
+            ctypes.windll.user32.SetProcessDPIAware()
+        except AttributeError:
+            pass # Not on Windows or ctypes issue
+
+    _WindowBase = ctk.CTk
+else:
+    _WindowBase = object # FileTreeBuilderApp is never instantiated without the GUI toolkit
+
+def get_scaling_factor():
+    """Returns the system DPI scaling factor (e.g. 1.0 for 100%, 1.5 for 150%)."""
+    try:
+        # For Windows 10 and up
+        shcore = ctypes.windll.shcore
+        # Assuming PROCESS_PER_MONITOR_DPI_AWARE was set
+        dpi_x = ctypes.c_uint()
+        dpi_y = ctypes.c_uint()
+        # Get DPI for the primary monitor (or monitor associated with point 0,0)
+        monitor = ctypes.windll.user32.MonitorFromPoint(wintypes.POINT(0, 0), 2) # MONITOR_DEFAULTTOPRIMARY
+        shcore.GetDpiForMonitor(monitor, 0, ctypes.byref(dpi_x), ctypes.byref(dpi_y)) # MDT_EFFECTIVE_DPI
+        return dpi_x.value / 96.0
+    except Exception:
+        try:
+            # Fallback method (older Windows)
+            hdc = ctypes.windll.user32.GetDC(0)
+            LOGPIXELSX = 88 # Used to query DPI
+            dpi = ctypes.windll.gdi32.GetDeviceCaps(hdc, LOGPIXELSX)
+            ctypes.windll.user32.ReleaseDC(0, hdc)
+            return dpi / 96.0
+        except Exception:
+            return 1.0 # Default if everything fails
+
 # ======================================================================
 # GUI Application Class (using CustomTkinter)
 # ======================================================================
-class FileTreeBuilderApp(ctk.CTk):
+PROGRESS_POLL_MS = 100 # The GUI shows worker progress at 10 Hz
+LOG_MAX_LINES = 1000 # Lines kept in the status log
+PROGRESS_LABEL_CHARS = 80
+
+class FileTreeBuilderApp(_WindowBase):
     def __init__(self):
         global app # Assign to the global reference
         super().__init__()
@@ -601,6 +3818,9 @@ class FileTreeBuilderApp(ctk.CTk):
         # --- CREATE STATUS WIDGETS EARLY ---
         self.status_label = ctk.CTkLabel(self.main_frame, text="Status / Log:")
         self.status_text = ctk.CTkTextbox(self.main_frame, height=100, state="disabled", wrap="word", activate_scrollbars=False)
+        self.progress_label = ctk.CTkLabel(self.main_frame, text="", anchor="w") # Latest progress message
+        self.progress = ProgressChannel() # status_callback of the generation thread
+        self.last_log_line = ""
 
         # --- 1. Folder Path + Browse (with drag-and-drop) ---
         self.folder_label = ctk.CTkLabel(self.main_frame, text="Folder Path:")
@@ -635,6 +3855,11 @@ class FileTreeBuilderApp(ctk.CTk):
                                                command=self.update_mode_ui)
         self.mode_dropdown.grid(row=1, column=1, padx=0, pady=10, sticky="w")
 
+        self.gitignore_var = tk.BooleanVar(value=bool(settings["use_gitignore"]))
+        self.gitignore_check = ctk.CTkCheckBox(self.main_frame, text="Respect .gitignore",
+                                               variable=self.gitignore_var)
+        self.gitignore_check.grid(row=1, column=1, columnspan=2, padx=0, pady=10, sticky="e")
+
         # --- 3. Classic / No Content mode fields (Ignore) ---
         self.ignore_label = ctk.CTkLabel(self.main_frame, text="Ignore Items:")
         self.ignore_ext_label = ctk.CTkLabel(self.main_frame, text="Ignore Exts:")
@@ -698,11 +3923,13 @@ class FileTreeBuilderApp(ctk.CTk):
 
         # --- 6. GRID the Status Textbox (created earlier) ---
         self.status_label.grid(row=5, column=0, padx=(0, 10), pady=(10, 0), sticky="nw")
+        self.progress_label.grid(row=5, column=1, columnspan=2, padx=0, pady=(10, 0), sticky="ew")
         self.status_text.grid(row=6, column=0, columnspan=3, padx=0, pady=(0,10), sticky="nsew")
         self.update_status("Ready. Select a folder and click 'Run Generation'.")
 
         # --- Initialize ---
         self.generation_thread = None
+        self.after(PROGRESS_POLL_MS, self._poll_progress)
         # Schedule the initial status update slightly delayed
         # self.after(50, lambda: self.update_status("Ready. Select a folder and click 'Run Generation'."))
 
@@ -753,24 +3980,49 @@ class FileTreeBuilderApp(ctk.CTk):
             internal.bind("<Control-Shift-Z>",      _manual_redo)
 
     def update_status(self, message):
-        """ Updates the status textbox safely. """
-        # (No changes needed in this method)
-        self.status_text.configure(state='normal')
+        """ Adds a message to the status log (GUI thread only; worker threads post to self.progress). """
         timestamp = datetime.datetime.now().strftime("%H:%M:%S")
+        self._append_log([(timestamp, message)])
+
+    def _append_log(self, entries):
+        """
+        Appends (timestamp, message) entries to the status textbox in one insert.
+        The log is a ring buffer: only the last LOG_MAX_LINES lines are kept.
+        """
+        lines = []
+        for timestamp, message in entries:
+            if message in self.last_log_line: # Skip repeats of the previous message
+                continue
+            self.last_log_line = f"[{timestamp}] {message}"
+            lines.append(self.last_log_line + "\n")
+        if not lines:
+            return
+        self.status_text.configure(state='normal')
+        self.status_text.insert(tk.END, "".join(lines))
         try:
-            last_msg = self.status_text.get("end-2l", "end-1l").strip()
-            if message in last_msg:
-                 self.status_text.configure(state='disabled')
-                 return
+            line_count = int(self.status_text.index("end-1c").split(".")[0])
+            if line_count > LOG_MAX_LINES:
+                self.status_text.delete("1.0", f"{line_count - LOG_MAX_LINES + 1}.0")
         except tk.TclError:
             pass
-        except Exception:
-             pass
-
-        self.status_text.insert(tk.END, f"[{timestamp}] {message}\n")
         self.status_text.configure(state='disabled')
         self.status_text.see(tk.END)
 
+    def _poll_progress(self):
+        """ Shows what the generation thread posted since the last poll; runs every PROGRESS_POLL_MS. """
+        messages, dropped, progress = self.progress.drain()
+        if dropped:
+            messages.insert(0, (datetime.datetime.now().strftime("%H:%M:%S"), f"... ({dropped} earlier messages not shown)"))
+        if messages:
+            self._append_log(messages)
+        if self.generation_thread is None or not self.generation_thread.is_alive():
+            progress = "" # Clear the progress line once the run is over
+        if progress is not None:
+            if len(progress) > PROGRESS_LABEL_CHARS:
+                progress = "…" + progress[-(PROGRESS_LABEL_CHARS - 1):]
+            self.progress_label.configure(text=progress)
+        self.after(PROGRESS_POLL_MS, self._poll_progress)
+
     def browse_folder(self):
         # (No changes needed in this method)
         folder_selected = filedialog.askdirectory()
@@ -817,35 +4069,6 @@ class FileTreeBuilderApp(ctk.CTk):
         # Always update status
         self.update_status(f"Mode switched to: {mode}")
 
-    def _parse_filters(self, filter_string):
-        # (No changes needed in this method)
-        if not filter_string:
-            return set()
-        filters = set()
-        for item in filter_string.split('|'):
-            item = item.strip()
-            if not item:
-                 continue
-            if item.startswith('*.'):
-                 ext = '.' + item[2:]
-                 filters.add(ext)
-            else:
-                 filters.add(item)
-        return filters
-
-    def _parse_extensions(self, ext_string):
-        # (No changes needed in this method)
-        extensions = set()
-        if not ext_string:
-            return extensions
-        for ext in ext_string.split('|'):
-            ext = ext.strip().lower()
-            if ext:
-                if not ext.startswith('.'):
-                    ext = '.' + ext
-                extensions.add(ext)
-        return extensions
-
     def start_generation(self):
         """ Starts the generation process in a separate thread. """
         global stop_requested, last_output_path
@@ -868,34 +4091,11 @@ class FileTreeBuilderApp(ctk.CTk):
         mode = self.mode_var.get()
 
         # --- Parse Filters (Main Thread) ---
-        all_ignored = set()
-        target_folders = set()
-        target_files = set()
-        target_extensions = set()
-
         try:
-            # Parse ignore filters for Classic and No Content modes
-            if mode == "Classic" or mode == "No Content":
-                ignore_items_str = self.ignore_var.get()
-                ignore_ext_str = self.ignore_ext_var.get()
-                ignored_items = self._parse_filters(ignore_items_str)
-                ignored_extensions = self._parse_extensions(ignore_ext_str)
-                all_ignored = ignored_items.union(ignored_extensions)
-                if mode == "Classic":
-                    self.update_status(f"Classic Mode: Ignoring {len(all_ignored)} patterns.")
-                else: # No Content mode
-                    self.update_status(f"No Content Mode: Applying {len(all_ignored)} ignore patterns to hierarchy.")
-
-            # Parse target filters for Target mode
-            elif mode == "Target":
-                target_items_str = self.target_var.get()
-                target_ext_str = self.target_ext_var.get()
-                target_folders_files = self._parse_filters(target_items_str)
-                target_extensions = self._parse_extensions(target_ext_str)
-                target_folders = set(item for item in target_folders_files if '/' not in item and '.' not in item and item)
-                target_files = target_folders_files - target_folders
-                self.update_status(f"Target Mode: Targeting {len(target_folders)} folders, {len(target_files)} files, {len(target_extensions)} extensions.")
-
+            rules = build_rules(mode, root_path,
+                                ignore_items=self.ignore_var.get(), ignore_exts=self.ignore_ext_var.get(),
+                                target_items=self.target_var.get(), target_exts=self.target_ext_var.get(),
+                                use_gitignore=self.gitignore_var.get(), status_callback=self.update_status)
         except Exception as e:
              self.update_status(f"Error parsing filters: {e}")
              messagebox.showerror("Filter Error", f"Could not parse filters:\n{e}")
@@ -908,6 +4108,7 @@ class FileTreeBuilderApp(ctk.CTk):
         self.folder_entry.configure(state="disabled")
         self.browse_button.configure(state="disabled")
         self.mode_dropdown.configure(state="disabled")
+        self.gitignore_check.configure(state="disabled")
         # Disable relevant filter fields based on mode
         if mode == "Classic" or mode == "No Content":
             self.ignore_entry.configure(state="disabled")
@@ -918,123 +4119,28 @@ class FileTreeBuilderApp(ctk.CTk):
 
         self.update_status(f"Starting generation for '{root_path.name}' in {mode} mode...")
 
-        # --- Prepare arguments for the thread ---
-        thread_args = (root_path, mode, all_ignored, target_folders, target_files, target_extensions)
-
         # --- Start the background thread ---
-        self.generation_thread = threading.Thread(target=self._run_generation_thread, args=thread_args, daemon=True)
+        self.generation_thread = threading.Thread(target=self._run_generation_thread, args=(root_path, mode, rules), daemon=True)
         self.generation_thread.start()
 
-    def _run_generation_thread(self, root_path, mode, all_ignored, target_folders, target_files, target_extensions):
+    def _run_generation_thread(self, root_path, mode, rules):
         """ The actual workhorse function running in the background thread. """
-        global stop_requested, last_output_path
+        global last_output_path
         try:
-            tree = None
-            # file_paths list is only needed for modes that include content
-            file_paths = None # Initialize as None
-
-            # --- Build Tree Structure ---
-            if mode == "Classic" or mode == "No Content":
-                safe_update(self.update_status, "Building tree structure...")
-                tree = build_tree(root_path, all_ignored, root_path, self.update_status)
-                if stop_requested: raise InterruptedError("Operation stopped by user.")
-                if tree is None and not stop_requested:
-                    safe_update(self.update_status, "Warning: Could not build tree structure (check permissions?).")
-                    tree = {} # Default to empty tree on error
-
-            elif mode == "Target":
-                safe_update(self.update_status, "Building target tree structure...")
-                tree = build_target_tree(root_path, target_folders, target_files, target_extensions, root_path, self.update_status)
-                if stop_requested: raise InterruptedError("Operation stopped by user.")
-                if tree is None and not stop_requested:
-                    safe_update(self.update_status, "Warning: Could not build target tree structure.")
-                    tree = {}
-
-            # --- Traverse Files (Only if content is needed) ---
-            if mode == "Classic":
-                safe_update(self.update_status, "Traversing files for content...")
-                file_paths = traverse_files(root_path, all_ignored, self.update_status)
-                if stop_requested: raise InterruptedError("Operation stopped by user.")
-                if file_paths is None and not stop_requested:
-                     safe_update(self.update_status, "Warning: Could not traverse files (check permissions?).")
-                     file_paths = [] # Default to empty list on error
-
-            elif mode == "Target":
-                safe_update(self.update_status, "Traversing target files for content...")
-                file_paths = traverse_target_files(root_path, target_folders, target_files, target_extensions, self.update_status)
-                if stop_requested: raise InterruptedError("Operation stopped by user.")
-                if file_paths is None and not stop_requested:
-                    safe_update(self.update_status, "Warning: Could not traverse target files.")
-                    file_paths = []
-
-            # For "No Content" mode, file_paths remains None or becomes [] implicitly
-
-            # Handle cases where nothing was found
-            if not tree and (file_paths is None or not file_paths) and not stop_requested: # Adjusted check
-                 safe_update(self.update_status, "Warning: No matching files or folders found based on filters.")
-                 tree = tree if tree is not None else {}
-                 file_paths = file_paths if file_paths is not None else [] # Ensure it's a list for write_file_contents
-
-            # --- Generate Output File ---
-            output_dir = Path(get_outputs_folder_path())
-            output_dir.mkdir(exist_ok=True)
-
-            folder_name = root_path.name if root_path.name else "root"
-            # Add mode to filename for clarity, especially for No Content
-            base_filename = f"{folder_name}_hierarchy_{mode.lower().replace(' ', '')}.txt"
-            output_file_path = output_dir / base_filename
-
-            counter = 1
-            while output_file_path.exists():
-                now_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                new_filename = f"{folder_name}_hierarchy_{mode.lower().replace(' ', '')}_{now_str}.txt"
-                output_file_path = output_dir / new_filename
-                counter += 1
-                if counter > 20:
-                    safe_update(self.update_status, "Error: Could not create unique output filename after multiple attempts.")
-                    raise IOError("Could not find a unique filename.")
-
-            safe_update(self.update_status, f"Writing output to: {output_file_path}")
-
-            with open(output_file_path, 'w', encoding='utf-8') as output_file:
-                # Option 2: show root folder name first
-                tree_lines = [root_path.name]
-                tree_lines += print_tree(tree)
-                write_hierarchy(output_file, tree_lines, self.update_status)
-                if stop_requested: raise InterruptedError("Operation stopped by user.")
-
-                # --- Write Content Section (Only if mode is NOT "No Content") ---
-                if mode != "No Content":
-                    # Ensure file_paths is a list before passing
-                    current_file_paths = file_paths if file_paths is not None else []
-                    write_ok = write_file_contents(output_file, root_path, current_file_paths, self.update_status)
-                    if not write_ok:
-                         raise InterruptedError("Operation stopped by user.")
-                else:
-                    # Optionally write a note that content was skipped
-                    output_file.write("File contents skipped in 'No Content' mode.\n")
-                    safe_update(self.update_status, "Skipping file content writing ('No Content' mode).")
-
+            output_file_path = run_generation(root_path, mode, rules, self.progress)
 
             last_output_path = output_file_path
             success_msg = f"✅ Generation complete! Output saved to:\n{output_file_path}"
-            safe_update(self.update_status, success_msg)
-            safe_update(self.ask_open_output_folder, output_dir)
+            safe_update(self.progress, success_msg)
+            safe_update(self.ask_open_output_folder, output_file_path.parent)
 
         except InterruptedError:
-            safe_update(self.update_status, "🛑 Operation stopped by user.")
-            if 'output_file_path' in locals() and output_file_path.exists():
-                try:
-                    with open(output_file_path, 'a', encoding='utf-8') as f:
-                        f.write("\n\n--- GENERATION INTERRUPTED ---\n")
-                    safe_update(self.update_status, f"Marked incomplete file: {output_file_path}")
-                except Exception as e_write:
-                    safe_update(self.update_status, f"Could not mark incomplete file: {e_write}")
+            safe_update(self.progress, "🛑 Operation stopped by user.")
 
         except Exception as e:
             error_msg = f"❌ An error occurred during generation: {e}"
             traceback.print_exc()
-            safe_update(self.update_status, error_msg + " (See console for details)")
+            safe_update(self.progress, error_msg + " (See console for details)")
             safe_update(messagebox.showerror, "Error", f"An error occurred during generation:\n{e}\n\n(Check console for full traceback)")
         finally:
             safe_update(self.enable_ui) # Ensure UI is re-enabled
@@ -1046,6 +4152,7 @@ class FileTreeBuilderApp(ctk.CTk):
             (self.folder_entry, "normal"),
             (self.browse_button, "normal"),
             (self.mode_dropdown, "normal"),
+            (self.gitignore_check, "normal"),
             (self.ignore_entry, "normal"),
             (self.ignore_ext_entry, "normal"),
             (self.target_entry, "normal"),
@@ -1141,6 +4248,9 @@ class FileTreeBuilderApp(ctk.CTk):
 # Main Execution Block
 # ======================================================================
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
+
     # Set CustomTkinter appearance
     ctk.set_appearance_mode("Dark")
     ctk.set_default_color_theme("blue")
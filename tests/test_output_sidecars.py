@@ -0,0 +1,107 @@
+"""
+Sidecar files (timing summary, profile, block index, manifest) of outputs that
+share a root and mode but differ in format or compression: each output keeps its own.
+
+Every test runs the command line from a copy of the app in a temporary folder, so
+outputs, caches and indexes land there instead of next to the repository's script.
+
+    python -m pytest tests
+"""
+import sys
+import json
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+SCRIPT_NAME = "file-tree-builder.py"
+
+
+@pytest.fixture
+def app(tmp_path):
+    """ Copy of the script and its helpers, with a small tree to snapshot. """
+    app_dir = tmp_path / "app"
+    app_dir.mkdir()
+    shutil.copy2(REPO_DIR / SCRIPT_NAME, app_dir / SCRIPT_NAME)
+    shutil.copytree(REPO_DIR / "helpers", app_dir / "helpers")
+    root = tmp_path / "w"
+    (root / "sub").mkdir(parents=True)
+    (root / "a.txt").write_text("alpha\n", encoding="utf-8")
+    (root / "sub" / "b.py").write_text("print('b')\n", encoding="utf-8")
+    return app_dir, root
+
+
+def run(app_dir, *args):
+    """ Runs the command line of the copied app; returns its stdout (the output path for a generation). """
+    result = subprocess.run([sys.executable, str(app_dir / SCRIPT_NAME), *map(str, args)],
+                            cwd=app_dir, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def generate(app_dir, root, *args):
+    return Path(run(app_dir, root, "-q", *args).strip())
+
+
+def test_compressed_and_plain_runs_keep_their_reports(app):
+    app_dir, root = app
+    plain = generate(app_dir, root, "--profile")
+    packed = generate(app_dir, root, "--profile", "--compress", "gzip")
+    assert plain.name == "w_hierarchy_classic.txt"
+    assert packed.name == "w_hierarchy_classic.txt.gz"
+
+    for output in (plain, packed):
+        for suffix in (".timing.json", ".prof", ".profile.txt"):
+            assert output.with_name(output.name + suffix).is_file(), output.name + suffix
+
+
+def test_block_indexes_of_outputs_with_one_stem(app):
+    app_dir, root = app
+    plain = generate(app_dir, root, "--block-index")
+    packed = generate(app_dir, root, "--block-index", "--compress", "gzip")
+    assert plain.stem == packed.name.split(".")[0]
+
+    for output in (plain, packed):
+        assert output.with_name(output.name + ".blocks.json").is_file()
+        block = run(app_dir, "extract", output, "a.txt")
+        assert block.startswith("a.txt:\n") and "alpha" in block
+
+
+def test_block_index_of_another_output_is_refused(app):
+    app_dir, root = app
+    plain = generate(app_dir, root, "--block-index")
+    packed = generate(app_dir, root, "--block-index", "--compress", "gzip")
+    shutil.copy2(plain.with_name(plain.name + ".blocks.json"), packed.with_name(packed.name + ".blocks.json"))
+
+    result = subprocess.run([sys.executable, str(app_dir / SCRIPT_NAME), "extract", str(packed), "a.txt"],
+                            cwd=app_dir, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 1
+    assert f"block index of {plain.name}, not of {packed.name}" in result.stderr
+
+
+def test_text_and_ndjson_runs_keep_their_sidecars(app):
+    app_dir, root = app
+    text = generate(app_dir, root, "--profile", "--block-index")
+    records = generate(app_dir, root, "--profile", "--block-index", "--format", "ndjson")
+    packed = generate(app_dir, root, "--profile", "--block-index", "--compress", "gzip")
+    assert [text.name, records.name] == ["w_hierarchy_classic.txt", "w_hierarchy_classic.ndjson"]
+
+    for output in (text, records, packed):
+        for suffix in (".timing.json", ".prof", ".profile.txt", ".blocks.json"):
+            assert output.with_name(output.name + suffix).is_file(), output.name + suffix
+    assert run(app_dir, "extract", text, "a.txt").startswith("a.txt:\n")
+    assert '"path":"a.txt"' in run(app_dir, "extract", records, "a.txt")
+
+
+def test_sharded_text_and_ndjson_runs_keep_their_manifests(app):
+    app_dir, root = app
+    text = generate(app_dir, root, "--shard-lines", "5")
+    records = generate(app_dir, root, "--shard-lines", "5", "--format", "ndjson")
+    assert [text.name, records.name] == ["w_hierarchy_classic_part001.txt", "w_hierarchy_classic_part001.ndjson"]
+
+    for output, manifest in ((text, "w_hierarchy_classic.txt.manifest.json"),
+                             (records, "w_hierarchy_classic.ndjson.manifest.json")):
+        parts = json.loads(output.with_name(manifest).read_text(encoding="utf-8"))["parts"]
+        assert parts[0]["file"] == output.name